@@ -87,6 +87,7 @@ MGMT_INTERFACE = 'mgmt0'
 NAT_INTERFACE = 'nat0'
 DEFAULT_CONFIGFILE = '/usr/local/etc/middleware.conf'
 SCROLLBACK_SIZE = 20 * 1024
+ID_ALPHABET = string.ascii_letters + string.digits
 
 vtx_enabled = False
 svm_features = False
@@ -145,7 +146,7 @@ class ConsoleToken(object):
 
 
 def generate_id():
-    return ''.join([random.choice(string.ascii_letters + string.digits) for _ in range(32)])
+    return ''.join([random.choice(ID_ALPHABET) for _ in range(32)])
 
 
 def get_docker_ports(details):
@@ -28,12 +28,16 @@
 import os
 import sys
 import json
+import time
 import unittest
 from threading import Event, Lock
 from freenas.dispatcher.rpc import RpcException
 from freenas.dispatcher.client import Client, ClientError
 
 
+VERBOSE = '-v' in sys.argv
+
+
 class BaseTestCase(unittest.TestCase):
     class TaskState(object):
         def __init__(self):
@@ -49,21 +53,25 @@ class BaseTestCase(unittest.TestCase):
         super(BaseTestCase, self).__init__(methodName)
         self.tasks = {}
         self.tasks_lock = Lock()
-        self.conn = None
         self.task_timeout = 30
 
+    @classmethod
+    def setUpClass(cls):
+        # One connection is shared by all tests of a class, so log in only once
+        cls.conn = Client()
+        cls.conn.connect(os.getenv('TESTHOST', '127.0.0.1'))
+        cls.conn.login_user(os.getenv('TESTUSER', 'root'), os.getenv('TESTPWD', ''), timeout=30)
+        cls.conn.subscribe_events('*')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.conn.disconnect()
+
     def setUp(self):
-        try:
-            self.conn = Client()
-            self.conn.event_callback = self.on_event
-            self.conn.connect(os.getenv('TESTHOST', '127.0.0.1'))
-            self.conn.login_user(os.getenv('TESTUSER', 'root'), os.getenv('TESTPWD', ''), timeout = self.task_timeout)
-            self.conn.subscribe_events('*')
-        except:
-            raise
+        self.conn.event_callback = self.on_event
 
     def tearDown(self):
-        self.conn.disconnect()
+        pass
 
     def submitTask(self, name, *args):
         with self.tasks_lock:
@@ -94,11 +102,25 @@ class BaseTestCase(unittest.TestCase):
             message = t.state    
         else:
             message = t.message
-        if not message:
+        if t.state != 'FINISHED':
+            # A failed task always gets its error fetched, it is what the assertion reports
+            message = self.query_task(tid) or message
+        elif not message and VERBOSE:
             self.query_task(tid)
  
         self.assertEqual(t.state, 'FINISHED', msg=message)
 
+    def assertAllTaskCompletion(self, *tids):
+        # Wait for all the tasks against one shared deadline before checking any of them,
+        # instead of giving each task its own task_timeout
+        deadline = time.time() + self.task_timeout
+        for tid in tids:
+            if not self.tasks[tid].ended.wait(max(deadline - time.time(), 0)):
+                self.fail('Task {0} timed out'.format(tid))
+
+        for tid in tids:
+            self.assertTaskCompletion(tid)
+
     def assertTaskFailure(self, tid):
         t = self.tasks[tid]
         if not t.ended.wait(self.task_timeout):
@@ -180,11 +202,14 @@ class BaseTestCase(unittest.TestCase):
         self.tasks_lock.release()    
 
     def pretty_print(self, res):
-        if '-v' in sys.argv:
-            print json.dumps(res, indent=4, sort_keys=True)
+        if not VERBOSE:
+            return
+
+        print json.dumps(res, indent=4, sort_keys=True)
 
     def query_task(self, tid):
         # Makes tests very slow, keep as debug
         query =  self.conn.call_sync('task.query', [('id','=',tid)])    
         message = query[0]['error']
         self.pretty_print(message)
+        return message
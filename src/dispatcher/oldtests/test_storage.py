@@ -38,10 +38,27 @@ class VolumeTest(BaseTestCase):
 
     def tearDown(self):
         # try to delete all volumes created with test
-        for u in self.conn.call_sync('volume.query', [('name', '~', 'Test*')]):
-            self.assertTaskCompletion(self.submitTask('volume.destroy', u['name']))
+        # submit all destroys first so they do not wait on each other
+        volumes = self.conn.call_sync('volume.query', [('name', '~', '^Test')])
+        self.assertAllTaskCompletion(*[self.submitTask('volume.destroy', u['name']) for u in volumes])
         super(VolumeTest, self).tearDown()
 
+    def prepare_volume(self, volname):
+        """Destroy leftovers of volname and return the disks available afterwards"""
+        # The client has no batched call and is not safe to share between threads,
+        # so these go one after another
+        v = self.conn.call_sync('volume.query', [('name', '=', volname)])
+        available = self.conn.call_sync('volume.get_available_disks')
+
+        # destroy leftovers so that test do not fail
+        # the create cannot be pipelined behind this destroy, it would race it for the volume name
+        if len(v):
+            tid = self.submitTask('volume.destroy', volname)
+            self.assertTaskCompletion(tid)
+            available = self.conn.call_sync('volume.get_available_disks')
+
+        return available
+
     def test_query_volumes(self):
         volumes = self.conn.call_sync('volume.query', [])
         self.assertIsInstance(volumes, list)
@@ -52,12 +69,7 @@ class VolumeTest(BaseTestCase):
         Create, test, destroy
         '''
         volname = 'TestVolumeAuto'
-        v =  self.conn.call_sync('volume.query', [('name', '=', volname)])
-        # destroy leftovers so that test do not fail
-        if len(v):
-            tid = self.submitTask('volume.destroy', volname)
-            self.assertTaskCompletion(tid)
-        available = self.conn.call_sync('volume.get_available_disks')    
+        available = self.prepare_volume(volname)
         if available:
             tid = self.submitTask('volume.create_auto', volname, 'zfs', available[:1])
             self.assertTaskCompletion(tid)
@@ -75,12 +87,7 @@ class VolumeTest(BaseTestCase):
         
     def test_create_volume_auto_available_disks(self):
         volname = 'TestVolumeAuto'
-        v =  self.conn.call_sync('volume.query', [('name', '=', volname)])
-        if len(v):
-            tid = self.submitTask('volume.destroy', volname)
-            self.assertTaskCompletion(tid)
-        
-        available = self.conn.call_sync('volume.get_available_disks')
+        available = self.prepare_volume(volname)
         if not available:
             raise unittest.SkipTest("No disks are available for creating volume, test did not run")
         else:
@@ -90,12 +97,7 @@ class VolumeTest(BaseTestCase):
     
     def test_create_stripe(self):
         volname = "TestVolume"
-        v =  self.conn.call_sync('volume.query', [('name', '=', volname)])
-        if len(v):
-            tid = self.submitTask('volume.destroy', volname)
-            self.assertTaskCompletion(tid)
-        
-        available = self.conn.call_sync('volume.get_available_disks')
+        available = self.prepare_volume(volname)
         if available:
             vdevs =  [{'type': 'disk', 'path': str(available[0])}]
             payload = {
@@ -114,12 +116,7 @@ class VolumeTest(BaseTestCase):
 
     def test_create_mirror(self):
         volname = "TestVolumeMirror"
-        v =  self.conn.call_sync('volume.query', [('name', '=', volname)])
-        if len(v):
-            tid = self.submitTask('volume.destroy', volname)
-            self.assertTaskCompletion(tid)
-        
-        available = self.conn.call_sync('volume.get_available_disks')
+        available = self.prepare_volume(volname)
         
         if len(available) >= 2:   
             vdevs =  [
@@ -138,11 +135,7 @@ class VolumeTest(BaseTestCase):
 
     def test_create_RAIDZ(self):
         volname = "TestVolume"
-        v =  self.conn.call_sync('volume.query', [('name', '=', volname)])
-        if len(v):
-            tid = self.submitTask('volume.destroy', volname)
-            self.assertTaskCompletion(tid)
-        available = self.conn.call_sync('volume.get_available_disks')
+        available = self.prepare_volume(volname)
 
         if len(available) < 3:
             raise unittest.SkipTest("No disks are available for creating volume, test did not run")   
@@ -76,8 +76,7 @@ class AFPConfigureTask(Task):
         try:
             node = ConfigNode('service.afp', self.configstore)
             node.update(afp)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'services')
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'afp')
+            self.dispatcher.call_sync('etcd.generation.generate_groups', ['services', 'afp'])
             self.dispatcher.dispatch_event('service.afp.changed', {
                 'operation': 'updated',
                 'ids': None,
@@ -105,8 +105,7 @@ class NFSConfigureTask(Task):
         try:
             node = ConfigNode('service.nfs', self.configstore)
             node.update(nfs)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'services')
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'nfs')
+            self.dispatcher.call_sync('etcd.generation.generate_groups', ['services', 'nfs'])
             self.dispatcher.dispatch_event('service.nfs.changed', {
                 'operation': 'updated',
                 'ids': None,
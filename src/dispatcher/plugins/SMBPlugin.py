@@ -156,64 +156,70 @@ def configure_params(smb, ad=False):
     conf = smbconf.SambaConfig('registry')
     conf.transaction_start()
     try:
-        conf['netbios name'] = smb['netbiosname'][0]
-        conf['netbios aliases'] = ' '.join(smb['netbiosname'][1:])
+        params = {
+            'netbios name': smb['netbiosname'][0],
+            'netbios aliases': ' '.join(smb['netbiosname'][1:]),
+            'server string': smb['description'],
+            'server max protocol': smb['max_protocol'],
+            'server min protocol': smb['min_protocol'],
+            'encrypt passwords': 'yes',
+            'dns proxy': 'no',
+            'strict locking': 'no',
+            'oplocks': 'yes',
+            'deadtime': '15',
+            'max log size': '51200',
+            'max open files': str(int(get_sysctl('kern.maxfilesperproc')) - 25),
+            'logging': 'logd@10',
+            'load printers': 'no',
+            'printing': 'bsd',
+            'printcap name': '/dev/null',
+            'disable spoolss': 'yes',
+            'getwd cache': 'yes',
+            'guest account': smb['guest_user'],
+            'map to guest': 'Bad User',
+            'obey pam restrictions': yesno(smb['obey_pam_restrictions']),
+            'directory name cache size': '0',
+            'kernel change notify': 'no',
+            'panic action': '/usr/local/libexec/samba/samba-backtrace',
+            'nsupdate command': '/usr/local/bin/samba-nsupdate -g',
+            'ea support': 'yes',
+            'store dos attributes': 'yes',
+            'lm announce': 'yes',
+            'hostname lookups': yesno(smb['hostlookup']),
+            'unix extensions': yesno(smb['unixext']),
+            'time server': yesno(smb['time_server']),
+            'acl allow execute always': yesno(smb['execute_always']),
+            'dos filemode': 'yes',
+            'multicast dns register': yesno(smb['zeroconf']),
+            'passdb backend': 'freenas',
+            'log level': str(getattr(LogLevel, smb['log_level']).value),
+            'username map': '/usr/local/etc/smbusers',
+            'idmap config *: range': '0-100000000',
+            'idmap config *: backend': 'freenas',
+            'ntlm auth': 'yes'
+        }
 
         if smb['bind_addresses']:
-            conf['interfaces'] = ' '.join(['127.0.0.1'] + smb['bind_addresses'])
-
-        conf['server string'] = smb['description']
-        conf['server max protocol'] = smb['max_protocol']
-        conf['server min protocol'] = smb['min_protocol']
-        conf['encrypt passwords'] = 'yes'
-        conf['dns proxy'] = 'no'
-        conf['strict locking'] = 'no'
-        conf['oplocks'] = 'yes'
-        conf['deadtime'] = '15'
-        conf['max log size'] = '51200'
-        conf['max open files'] = str(int(get_sysctl('kern.maxfilesperproc')) - 25)
-        conf['logging'] = 'logd@10'
-
-        if 'filemask' in smb:
-            if smb['filemask'] is not None:
-                conf['create mode'] = perm_to_oct_string(get_unix_permissions(smb['filemask'])).zfill(4)
-
-        if 'dirmask' in smb:
-            if smb['dirmask'] is not None:
-                conf['directory mode'] = perm_to_oct_string(get_unix_permissions(smb['dirmask'])).zfill(4)
-
-        conf['load printers'] = 'no'
-        conf['printing'] = 'bsd'
-        conf['printcap name'] = '/dev/null'
-        conf['disable spoolss'] = 'yes'
-        conf['getwd cache'] = 'yes'
-        conf['guest account'] = smb['guest_user']
-        conf['map to guest'] = 'Bad User'
-        conf['obey pam restrictions'] = yesno(smb['obey_pam_restrictions'])
-        conf['directory name cache size'] = '0'
-        conf['kernel change notify'] = 'no'
-        conf['panic action'] = '/usr/local/libexec/samba/samba-backtrace'
-        conf['nsupdate command'] = '/usr/local/bin/samba-nsupdate -g'
-        conf['ea support'] = 'yes'
-        conf['store dos attributes'] = 'yes'
-        conf['lm announce'] = 'yes'
-        conf['hostname lookups'] = yesno(smb['hostlookup'])
-        conf['unix extensions'] = yesno(smb['unixext'])
-        conf['time server'] = yesno(smb['time_server'])
-        conf['acl allow execute always'] = yesno(smb['execute_always'])
-        conf['dos filemode'] = 'yes'
-        conf['multicast dns register'] = yesno(smb['zeroconf'])
-        conf['passdb backend'] = 'freenas'
-        conf['log level'] = str(getattr(LogLevel, smb['log_level']).value)
-        conf['username map'] = '/usr/local/etc/smbusers'
-        conf['idmap config *: range'] = '0-100000000'
-        conf['idmap config *: backend'] = 'freenas'
-        conf['ntlm auth'] = 'yes'
+            params['interfaces'] = ' '.join(['127.0.0.1'] + smb['bind_addresses'])
+
+        if smb.get('filemask') is not None:
+            params['create mode'] = perm_to_oct_string(get_unix_permissions(smb['filemask'])).zfill(4)
+
+        if smb.get('dirmask') is not None:
+            params['directory mode'] = perm_to_oct_string(get_unix_permissions(smb['dirmask'])).zfill(4)
 
         if not ad:
-            conf['local master'] = yesno(smb['local_master'])
-            conf['server role'] = 'auto'
-            conf['workgroup'] = smb['workgroup']
+            params['local master'] = yesno(smb['local_master'])
+            params['server role'] = 'auto'
+            params['workgroup'] = smb['workgroup']
+
+        for k, v in params.items():
+            # Registry writes are tdb operations, so skip values that are already in place
+            with contextlib.suppress(KeyError):
+                if conf[k] == v:
+                    continue
+
+            conf[k] = v
     except BaseException as err:
         logger.error('Failed to update samba registry: {0}'.format(err), exc_info=True)
         conf.transaction_cancel()
@@ -147,8 +147,7 @@ class UPSConfigureTask(Task):
         try:
             node = ConfigNode('service.ups', self.configstore)
             node.update(ups)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'services')
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'ups')
+            self.dispatcher.call_sync('etcd.generation.generate_groups', ['services', 'ups'])
             self.dispatcher.dispatch_event('service.ups.changed', {
                 'operation': 'updated',
                 'ids': None,
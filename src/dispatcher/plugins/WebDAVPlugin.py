@@ -89,8 +89,7 @@ class WebDAVConfigureTask(Task):
         try:
             node = ConfigNode('service.webdav', self.configstore)
             node.update(webdav)
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'services')
-            self.dispatcher.call_sync('etcd.generation.generate_group', 'webdav')
+            self.dispatcher.call_sync('etcd.generation.generate_groups', ['services', 'webdav'])
             self.dispatcher.dispatch_event('service.webdav.changed', {
                 'operation': 'updated',
                 'ids': None,
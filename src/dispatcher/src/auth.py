@@ -25,14 +25,17 @@
 #
 #####################################################################
 
+import time
 import string
 import random
 import gevent
 import logging
+from collections import OrderedDict
 from freenas.dispatcher.rpc import RpcException
 from lib.freebsd import sockstat
 
 logger = logging.getLogger('dispatcher.auth')
+ID_ALPHABET = string.ascii_letters + string.digits
 
 
 class User(object):
@@ -47,7 +50,7 @@ class User(object):
         return self.pwcheck(self.name, password)
 
     def check_local(self, client_addr, client_port, server_port):
-        client = '{0}:{1}'.format(client_addr, client_port)
+        client = client_addr + ':' + str(client_port)
         for sock in sockstat(True, [server_port]):
             if sock['local'] == client:
                 return True
@@ -62,14 +65,54 @@ class Service(object):
     def __init__(self):
         self.name = None
 
-    def has_role(self, role):
+    @staticmethod
+    def has_role(role):
         return True
 
 
+class UserCache(object):
+    def __init__(self, maxsize=1000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.store = OrderedDict()
+
+    def __len__(self):
+        return len(self.store)
+
+    def __contains__(self, name):
+        return self.get(name) is not None
+
+    def __setitem__(self, name, user):
+        self.store.pop(name, None)
+        self.store[name] = (user, time.monotonic() + self.ttl)
+        while len(self.store) > self.maxsize:
+            self.store.popitem(last=False)
+
+    def get(self, name, default=None):
+        item = self.store.get(name)
+        if not item:
+            return default
+
+        user, expires_at = item
+        if expires_at < time.monotonic():
+            del self.store[name]
+            return default
+
+        self.store.move_to_end(name)
+        return user
+
+    def pop(self, name, default=None):
+        item = self.store.pop(name, None)
+        return item[0] if item else default
+
+    def clear(self):
+        self.store.clear()
+
+
 class PasswordAuthenticator(object):
     def __init__(self, dispatcher):
         self.dispatcher = dispatcher
-        self.users = {}
+        self.users = UserCache()
 
     def get_user(self, name):
         try:
@@ -174,7 +217,7 @@ class TokenStore(object):
         self.tokens = {}
 
     def generate_id(self):
-        return ''.join([random.choice(string.ascii_letters + string.digits) for n in range(32)])
+        return ''.join([random.choice(ID_ALPHABET) for n in range(32)])
 
     def issue_token(self, token):
         token_id = self.generate_id()
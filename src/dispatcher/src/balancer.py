@@ -26,6 +26,7 @@
 #####################################################################
 
 import os
+import time
 import gevent
 import logging
 import traceback
@@ -33,10 +34,11 @@ import errno
 import copy
 import uuid
 import fnmatch
-import inspect
 import subprocess
 import bsd
 import signal
+import contextlib
+import itertools
 from lib.freebsd import get_sysctl
 from threading import Condition
 from datetime import datetime
@@ -59,6 +61,13 @@ import collections
 
 
 TASKWORKER_PATH = '/usr/local/libexec/taskworker'
+PERSIST_INTERVAL = 2
+TASK_CHANGED_DELAY = 0.02
+TASK_OUTPUT_LINES = 10000
+OUTPUT_CHUNK_SIZE = 65536
+WARM_EXECUTORS = 2
+EXECUTOR_IDLE_TIMEOUT = 300
+MAX_EXECUTORS = 64
 ERROR_TYPES = {
     'RpcException': RpcException,
     'TaskException': TaskException,
@@ -85,6 +94,7 @@ class WorkerState(object):
     ASSIGNED = 'ASSIGNED'
     EXECUTING = 'EXECUTING'
     STARTING = 'STARTING'
+    EXITING = 'EXITING'
 
 
 class TaskExecutor(object):
@@ -96,20 +106,31 @@ class TaskExecutor(object):
         self.pid = None
         self.conn = None
         self.state = WorkerState.STARTING
+        self.idle_since = None
         self.key = str(uuid.uuid4())
         self.result = AsyncResult()
         self.exiting = False
         self.killed = False
         self.thread = gevent.spawn(self.executor)
         self.cv = Condition()
-        self.status_lock = RLock()
 
     def checkin(self, conn):
         with self.cv:
             self.balancer.logger.debug('Check-in of worker #{0} (key {1})'.format(self.index, self.key))
+            if self.conn:
+                self.balancer.executors_by_conn.pop(self.conn, None)
+
             self.conn = conn
-            self.state = WorkerState.IDLE
-            self.cv.notify_all()
+            self.balancer.executors_by_conn[conn] = self
+            self.set_idle()
+
+    def set_idle(self):
+        # Must be called with self.cv held
+        self.state = WorkerState.IDLE
+        self.idle_since = time.monotonic()
+        self.balancer.idle_executors.append(self)
+        self.balancer.executor_released.set()
+        self.cv.notify_all()
 
     def put_progress(self, progress):
         st = TaskStatus(None)
@@ -117,17 +138,18 @@ class TaskExecutor(object):
         self.task.set_state(progress=st)
 
     def put_status(self, status):
-        with self.cv:
-            # Try to collect rusage at this point, when process is still alive
-            try:
-                kinfo = self.balancer.dispatcher.threaded(bsd.kinfo_getproc, self.pid)
-                self.task.rusage = kinfo.rusage
-            except LookupError:
-                pass
+        if status['status'] == 'ROLLBACK':
+            self.task.set_state(TaskState.ROLLBACK)
+            return
 
-            if status['status'] == 'ROLLBACK':
-                self.task.set_state(TaskState.ROLLBACK)
+        # Try to collect rusage at this point, when process is still alive
+        try:
+            kinfo = self.balancer.dispatcher.threaded(bsd.kinfo_getproc, self.pid)
+            self.task.rusage = kinfo.rusage
+        except LookupError:
+            pass
 
+        with self.cv:
             if status['status'] == 'FINISHED':
                 self.result.set(status['result'])
 
@@ -160,10 +182,6 @@ class TaskExecutor(object):
         self.conn.call_sync('taskproxy.update_env', env)
 
     def run(self, task):
-        def match_file(module, f):
-            name, ext = os.path.splitext(f)
-            return module == name and ext in ['.py', '.pyc', '.so']
-
         with self.cv:
             self.cv.wait_for(lambda: self.state == WorkerState.ASSIGNED)
             self.result = AsyncResult()
@@ -174,29 +192,15 @@ class TaskExecutor(object):
 
         self.balancer.logger.debug('Actually starting task {0}'.format(task.id))
 
-        filename = None
-        module_name = inspect.getmodule(task.clazz).__name__
-        for dir in self.balancer.dispatcher.plugin_dirs:
-            found = False
-            try:
-                for root, _, files in os.walk(dir):
-                    file = first_or_default(lambda f: match_file(module_name, f), files)
-                    if file:
-                        filename = os.path.join(root, file)
-                        found = True
-                        break
-
-                if found:
-                    break
-            except OSError:
-                continue
+        if not task.filename:
+            task.filename = self.balancer.get_task_filename(task.clazz)
 
         try:
             self.conn.call_sync('taskproxy.run', {
                 'id': task.id,
                 'user': task.user,
                 'class': task.clazz.__name__,
-                'filename': filename,
+                'filename': task.filename,
                 'args': task.args,
                 'debugger': task.debugger,
                 'environment': task.environment,
@@ -237,8 +241,7 @@ class TaskExecutor(object):
                 self.task.ended.set()
 
                 if self.state == WorkerState.EXECUTING:
-                    self.state = WorkerState.IDLE
-                    self.cv.notify_all()
+                    self.set_idle()
 
             self.balancer.task_exited(self.task)
             return
@@ -248,8 +251,7 @@ class TaskExecutor(object):
             self.task.set_state(TaskState.FINISHED, TaskStatus(100, ''))
             self.task.ended.set()
             if self.state == WorkerState.EXECUTING:
-                self.state = WorkerState.IDLE
-                self.cv.notify_all()
+                self.set_idle()
 
         self.balancer.task_exited(self.task)
 
@@ -265,14 +267,15 @@ class TaskExecutor(object):
             self.balancer.logger.warning("Killing process {0}".format(self.pid))
             self.killed = True
             self.terminate()
+            return True
 
-            # Now kill all the subtasks
-            for subtask in filter(lambda t: t.parent is self.task, self.balancer.task_list):
-                self.balancer.logger.warning("Aborting subtask {0} because parent task {1} died".format(
-                    subtask.id,
-                    self.task.id
-                ))
-                self.balancer.abort(subtask.id)
+        return False
+
+    def put_output(self, line):
+        line = line.decode('utf8')
+        self.balancer.logger.debug('Executor #{0}: {1}'.format(self.index, line.strip()))
+        if self.task:
+            self.task.output.append(line)
 
     def terminate(self):
         try:
@@ -286,7 +289,7 @@ class TaskExecutor(object):
                 self.proc = Popen(
                     [TASKWORKER_PATH, self.key, str(self.index)],
                     close_fds=True,
-                    preexec_fn=os.setpgrp,
+                    start_new_session=True,
                     stdout=subprocess.PIPE,
                     stderr=subprocess.STDOUT)
 
@@ -297,11 +300,18 @@ class TaskExecutor(object):
                 self.balancer.logger.error('Cannot spawn task executor #{0}'.format(self.index))
                 return
 
-            for line in self.proc.stdout:
-                line = line.decode('utf8')
-                self.balancer.logger.debug('Executor #{0}: {1}'.format(self.index, line.strip()))
-                if self.task:
-                    self.task.output += line
+            pending = b''
+            while True:
+                chunk = self.proc.stdout.read1(OUTPUT_CHUNK_SIZE)
+                if not chunk:
+                    break
+
+                *lines, pending = (pending + chunk).split(b'\n')
+                for line in lines:
+                    self.put_output(line + b'\n')
+
+            if pending:
+                self.put_output(pending)
 
             self.proc.wait()
 
@@ -343,6 +353,7 @@ class Task(object):
         self.id = None
         self.name = name
         self.clazz = None
+        self.filename = None
         self.args = None
         self.user = None
         self.session_id = None
@@ -356,14 +367,16 @@ class Task(object):
         self.hooks = {}
         self.instance = None
         self.parent = None
+        self.subtasks = []
         self.result = None
-        self.output = ''
+        self.output = collections.deque(maxlen=TASK_OUTPUT_LINES)
         self.rusage = None
         self.slock = RLock()
         self.ended = Event()
         self.debugger = None
         self.executor = None
         self.strict_verify = None
+        self.progress_template = None
 
     def __getstate__(self):
         return {
@@ -379,28 +392,32 @@ class Task(object):
             "args": remove_dots(self.args),
             "result": remove_dots(self.result),
             "state": self.state,
-            "output": self.output,
+            "output": self.get_output(),
             "rusage": self.rusage,
             "error": self.error,
             "warnings": self.warnings,
             "debugger": self.debugger,
             "environment": self.environment,
-            "abortable": True if (hasattr(self.clazz, 'abort') and isinstance(self.clazz.abort, collections.Callable)) else False
+            "abortable": callable(getattr(self.clazz, 'abort', None))
         }
 
     def __emit_progress(self):
-        self.dispatcher.dispatch_event("task.progress", {
+        self.dispatcher.dispatch_event("task.progress", dict(
+            self.progress_template,
+            state=self.state,
+            percentage=self.progress.percentage,
+            message=self.progress.message,
+            extra=self.progress.extra
+        ))
+
+    def start(self):
+        self.progress_template = {
             "id": self.id,
             "name": self.name,
-            "state": self.state,
             "nolog": True,
-            "percentage": self.progress.percentage,
-            "message": self.progress.message,
-            "extra": self.progress.extra,
-            "abortable": True if (hasattr(self.instance, 'abort') and isinstance(self.instance.abort, collections.Callable)) else False
-        })
+            "abortable": callable(getattr(self.instance, 'abort', None))
+        }
 
-    def start(self):
         try:
             self.balancer.assign_executor(self)
         except OverflowError:
@@ -424,6 +441,11 @@ class Task(object):
             if error:
                 self.error = error
 
+            if self.state == TaskState.EXECUTING:
+                self.balancer.executing_tasks.add(self)
+            else:
+                self.balancer.executing_tasks.discard(self)
+
             if self.state == TaskState.EXECUTING:
                 if not self.started_at:
                     self.started_at = datetime.utcnow()
@@ -439,44 +461,51 @@ class Task(object):
                 self.progress = TaskStatus(0)
 
             self.dispatcher.dispatch_event('task.created' if self.state == TaskState.CREATED else 'task.updated', event)
-            self.dispatcher.datastore_log.update('tasks', self.id, self)
-            self.dispatcher.dispatch_event('task.changed', {
-                'operation': 'create' if state == TaskState.CREATED else 'update',
-                'ids': [self.id]
-            })
+            if state or error:
+                self.persist()
+            else:
+                self.persist_later()
+
+            if state == TaskState.CREATED:
+                self.dispatcher.dispatch_event('task.changed', {
+                    'operation': 'create',
+                    'ids': [self.id]
+                })
+            else:
+                self.balancer.task_changed(self)
 
             if progress and self.state not in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
                 self.progress = progress
                 self.__emit_progress()
 
             if self.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
-                try:
-                    # Remove all subtasks
-                    for i in filter(lambda t: t.parent is self, self.balancer.task_list):
-                        self.balancer.task_list.remove(i)
+                self.balancer.retire_task(self)
+
+    def persist(self):
+        with self.slock:
+            self.balancer.dirty_tasks.discard(self)
+            self.dispatcher.datastore_log.update('tasks', self.id, self)
 
-                    # If top-level task, also remove self
-                    if self.parent is None:
-                        self.balancer.task_list.remove(self)
-                except ValueError:
-                    # failed in verify stage
-                    pass
+    def persist_later(self):
+        # Progress-only updates are written out by Balancer.persist_thread
+        self.balancer.dirty_tasks.add(self)
 
     def set_env(self, key, value):
         self.environment[key] = value
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.persist()
+
+    def get_output(self):
+        return ''.join(self.output)
 
     def set_output(self, output):
-        self.output = output
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
+        self.output.clear()
+        self.output.extend(output.splitlines(keepends=True))
+        self.persist()
 
     def add_warning(self, warning):
         self.warnings.append(warning)
-        self.dispatcher.datastore_log.update('tasks', self.id, self)
-        self.dispatcher.dispatch_event('task.changed', {
-            'operation': 'update',
-            'ids': [self.id]
-        })
+        self.persist()
+        self.balancer.task_changed(self)
 
     def get_description(self):
         if not self.description:
@@ -496,14 +525,27 @@ class Balancer(object):
         self.dispatcher = dispatcher
         self.task_list = []
         self.task_queue = Queue()
+        self.waiting_tasks = collections.deque()
+        self.executing_tasks = set()
+        self.tasks_by_id = {}
+        self.dirty_tasks = set()
+        self.validators = {}
         self.resource_graph = dispatcher.resource_graph
         self.threads = []
         self.executors = []
+        self.executors_by_key = {}
+        self.executors_by_conn = {}
+        self.idle_executors = collections.deque()
+        self.executor_index = itertools.count()
+        self.warm_pool_event = Event()
+        self.executor_released = Event()
         self.logger = logging.getLogger('Balancer')
         self.dispatcher.require_collection('tasks', 'serial', type='log')
         self.create_initial_queues()
         self.schedule_lock = RLock()
         self.distribution_lock = RLock()
+        self.changed_tasks = collections.OrderedDict()
+        self.changed_timer = None
         self.debugger = None
         self.debugged_tasks = None
         self.dispatcher.register_event_type('task.changed')
@@ -541,12 +583,14 @@ class Balancer(object):
     def start_executors(self):
         for i in range(0, max(get_sysctl("hw.ncpu"), 2)):
             self.logger.info('Starting task executor #{0}...'.format(i))
-            self.executors.append(TaskExecutor(self, i))
+            self.add_executor()
 
     def start(self):
         self.clean_stale_tasks()
         self.start_executors()
         self.threads.append(gevent.spawn(self.distribution_thread))
+        self.threads.append(gevent.spawn(self.persist_thread))
+        self.threads.append(gevent.spawn(self.warm_pool_thread))
         self.logger.info("Started")
 
     def schema_to_list(self, schema):
@@ -557,10 +601,14 @@ class Balancer(object):
             'maxItems': len(schema)
         }
 
-    def verify_schema(self, clazz, args, strict=False):
+    def get_validator(self, clazz, strict=False):
+        val = self.validators.get((clazz, strict))
+        if val:
+            return val
+
         params_schema = clazz._get_schema()
         if not params_schema:
-            return []
+            return None
 
         schema = self.schema_to_list(params_schema)
         val = validator.create_validator(schema, resolver=self.dispatcher.rpc.get_schema_resolver(schema))
@@ -569,6 +617,14 @@ class Balancer(object):
         else:
             val.remove_read_only = True
 
+        self.validators[(clazz, strict)] = val
+        return val
+
+    def verify_schema(self, clazz, args, strict=False):
+        val = self.get_validator(clazz, strict)
+        if not val:
+            return []
+
         return list(val.iter_errors(args))
 
     def submit(self, name, args, sender, env=None):
@@ -582,14 +638,14 @@ class Balancer(object):
         task.created_at = datetime.utcnow()
         task.clazz = self.dispatcher.tasks[name]
         task.hooks = self.dispatcher.task_hooks.get(name, {})
-        task.args = copy.deepcopy(args)
+        task.args = copy_args(args)
         task.strict_verify = 'strict_validation' in sender.enabled_features
 
         if env:
             if not isinstance(env, dict):
                 raise ValueError('env must be a dict')
 
-            task.environment = copy.deepcopy(env)
+            task.environment = copy_args(env)
 
         if self.debugger:
             for m in self.debugged_tasks:
@@ -600,6 +656,7 @@ class Balancer(object):
             task.user = task.environment['RUN_AS_USER']
 
         task.id = self.dispatcher.datastore_log.insert("tasks", task)
+        self.tasks_by_id[task.id] = task
         task.environment['SENDER_ADDRESS'] = sender.client_address
         task.environment['ID'] = task.id
         task.set_state(TaskState.CREATED)
@@ -658,6 +715,27 @@ class Balancer(object):
         task_id = self.submit(task_name, args, sender, env)
         return task_id, url_list
 
+    def get_task_filename(self, clazz):
+        def match_file(module, f):
+            name, ext = os.path.splitext(f)
+            return module == name and ext in ['.py', '.pyc', '.so']
+
+        module_name = clazz.__module__
+
+        # Task classes normally come from loaded plugins, which already know their file
+        plugin = self.dispatcher.plugins.get(module_name)
+        if plugin:
+            return plugin.filename
+
+        for dir in self.dispatcher.plugin_dirs:
+            try:
+                for root, _, files in os.walk(dir):
+                    file = first_or_default(lambda f: match_file(module_name, f), files)
+                    if file:
+                        return os.path.join(root, file)
+            except OSError:
+                continue
+
     def verify_subtask(self, parent, name, args):
         clazz = self.dispatcher.tasks[name]
         instance = clazz(self.dispatcher)
@@ -674,7 +752,10 @@ class Balancer(object):
         task.instance.verify(*task.args)
         task.description = task.instance.describe(*task.args)
         task.id = self.dispatcher.datastore_log.insert("tasks", task)
+        self.tasks_by_id[task.id] = task
         task.parent = parent
+        if parent:
+            parent.subtasks.append(task)
         task.environment = {'ID': task.id}
 
         if parent:
@@ -709,15 +790,29 @@ class Balancer(object):
             self.logger.warning("Cannot abort task: unknown task id %d", id)
             return
 
-        success = False
-        if task.started_at is None:
-            success = True
-        else:
-            try:
-                task.executor.abort()
-            except:
-                pass
-        if success:
+        pending = collections.deque([(task, error)])
+        while pending:
+            task, error = pending.popleft()
+            if task.state in (TaskState.FINISHED, TaskState.FAILED, TaskState.ABORTED):
+                continue
+
+            if task.started_at is not None:
+                try:
+                    killed = task.executor.abort()
+                except:
+                    continue
+
+                if killed:
+                    # Task process is gone, so nobody is going to abort its subtasks but us
+                    for subtask in task.subtasks:
+                        self.logger.warning("Aborting subtask {0} because parent task {1} died".format(
+                            subtask.id,
+                            task.id
+                        ))
+                        pending.append((subtask, None))
+
+                continue
+
             task.ended.set()
             if error:
                 task.set_state(TaskState.FAILED, TaskStatus(0), serialize_error(error))
@@ -726,6 +821,38 @@ class Balancer(object):
                 task.set_state(TaskState.ABORTED, TaskStatus(0, "Aborted"))
                 self.logger.debug("Task ID: %d, name: %s aborted by user", task.id, task.name)
 
+    def retire_task(self, task):
+        with contextlib.suppress(ValueError):
+            self.waiting_tasks.remove(task)
+
+        # Remove all subtasks
+        for i in [t for t in self.task_list if t.parent is task]:
+            self.task_list.remove(i)
+            self.tasks_by_id.pop(i.id, None)
+
+        # If top-level task, also remove self
+        if task.parent is None:
+            with contextlib.suppress(ValueError):
+                # might have failed in verify stage
+                self.task_list.remove(task)
+
+            self.tasks_by_id.pop(task.id, None)
+
+    def task_changed(self, task):
+        # Coalesce task.changed update events fired in quick succession into one
+        self.changed_tasks[task.id] = True
+        if not self.changed_timer:
+            self.changed_timer = gevent.spawn_later(TASK_CHANGED_DELAY, self.flush_task_changes)
+
+    def flush_task_changes(self):
+        ids = list(self.changed_tasks)
+        self.changed_tasks.clear()
+        self.changed_timer = None
+        self.dispatcher.dispatch_event('task.changed', {
+            'operation': 'update',
+            'ids': ids
+        })
+
     def task_exited(self, task):
         self.resource_graph.release(*task.resources)
         self.schedule_tasks(True)
@@ -738,19 +865,20 @@ class Balancer(object):
         """
         with self.schedule_lock:
             started = 0
-            executing_tasks = [t for t in self.task_list if t.state == TaskState.EXECUTING]
-            waiting_tasks = [t for t in self.task_list if t.state == TaskState.WAITING]
+            waiting = len(self.waiting_tasks)
 
-            for task in waiting_tasks:
+            for _ in range(waiting):
+                task = self.waiting_tasks.popleft()
                 if not self.resource_graph.can_acquire(*task.resources):
+                    self.waiting_tasks.append(task)
                     continue
 
                 self.resource_graph.acquire(*task.resources)
                 self.threads.append(task.start())
                 started += 1
 
-            if not started and not executing_tasks and (exit or len(waiting_tasks) == 1):
-                for task in waiting_tasks:
+            if not started and not self.executing_tasks and (exit or waiting == 1):
+                for task in list(self.waiting_tasks):
                     # Check whether or not task waits on nonexistent resources. If it does,
                     # abort it 'cause there's no chance anymore that missing resources will appear.
                     missing_resources = [r for r in task.resources if self.resource_graph.get_resource(r) is None]
@@ -763,8 +891,6 @@ class Balancer(object):
 
     def distribution_thread(self):
         while True:
-            self.task_queue.peek()
-            self.distribution_lock.acquire()
             task = self.task_queue.get()
 
             try:
@@ -783,6 +909,9 @@ class Balancer(object):
                 task.resources = task.instance.verify(*task.args)
                 task.description = task.instance.describe(*task.args)
 
+                # Resolve plugin file now, so executor doesn't have to once task gets scheduled
+                task.filename = self.get_task_filename(task.clazz)
+
                 if type(task.resources) is not list:
                     raise ValueError("verify() returned something else than resource list")
 
@@ -790,38 +919,108 @@ class Balancer(object):
                 self.logger.warning("Cannot verify task %d: %s", task.id, err)
                 task.set_state(TaskState.FAILED, TaskStatus(0), serialize_error(err))
                 task.ended.set()
-                self.distribution_lock.release()
 
                 if not isinstance(err, VerifyException):
                     self.dispatcher.report_error('Task {0} verify() method raised invalid exception'.format(err), err)
 
                 continue
 
-            task.set_state(TaskState.WAITING)
-            self.task_list.append(task)
-            self.distribution_lock.release()
+            with self.distribution_lock:
+                task.set_state(TaskState.WAITING)
+                self.task_list.append(task)
+                self.waiting_tasks.append(task)
+
             self.schedule_tasks()
             if task.resources:
                 self.logger.debug("Task %d assigned to resources %s", task.id, ','.join(task.resources))
 
+    def persist_thread(self):
+        # Single ticker flushing coalesced task updates, instead of a timer per task
+        while True:
+            gevent.sleep(PERSIST_INTERVAL)
+            for task in list(self.dirty_tasks):
+                task.persist()
+
     def assign_executor(self, task):
-        for i in self.executors:
-            with i.cv:
-                if i.state == WorkerState.IDLE:
-                    self.logger.info("Task %d assigned to executor #%d", task.id, i.index)
-                    task.executor = i
-                    i.state = WorkerState.ASSIGNED
-                    return
+        while True:
+            self.executor_released.clear()
+            while self.idle_executors:
+                i = self.idle_executors.popleft()
+                with i.cv:
+                    # Executor might have died or been assigned since it was queued
+                    if i.state == WorkerState.IDLE:
+                        self.logger.info("Task %d assigned to executor #%d", task.id, i.index)
+                        task.executor = i
+                        i.state = WorkerState.ASSIGNED
+                        self.warm_pool_event.set()
+                        return
+
+            if len(self.executors) < self.get_max_executors():
+                break
+
+            # At the executor limit, wait for a running task to give its executor back
+            self.logger.debug("Task %d waiting for a free executor", task.id)
+            self.executor_released.wait()
 
         # Out of executors! Need to spawn new one
-        executor = TaskExecutor(self, len(self.executors))
-        self.executors.append(executor)
+        executor = self.add_executor()
         with executor.cv:
             executor.cv.wait_for(lambda: executor.state == WorkerState.IDLE)
             executor.state = WorkerState.ASSIGNED
             task.executor = executor
             self.logger.info("Task %d assigned to executor #%d", task.id, executor.index)
 
+    def warm_pool_thread(self):
+        # Keep a few spare executors spawned and checked in, so that bursts of tasks
+        # don't have to wait for a fresh executor process in assign_executor()
+        while True:
+            self.warm_pool_event.wait(EXECUTOR_IDLE_TIMEOUT)
+            self.warm_pool_event.clear()
+            warm = self.dispatcher.configstore.get('middleware.warm_executors')
+            limit = self.get_max_executors()
+            if warm is None:
+                warm = WARM_EXECUTORS
+
+            spare = len([e for e in self.executors if e.state in (WorkerState.IDLE, WorkerState.STARTING)])
+            while spare < warm and len(self.executors) < limit:
+                executor = self.add_executor()
+                self.logger.info('Started spare task executor #{0}'.format(executor.index))
+                spare += 1
+
+            # Retire executors left over from a burst once they have been idle for a while
+            now = time.monotonic()
+            stale = sorted(
+                (e for e in self.executors if e.state == WorkerState.IDLE and now - e.idle_since >= EXECUTOR_IDLE_TIMEOUT),
+                key=lambda e: e.idle_since
+            )
+
+            for e in stale[:max(spare - warm, 0)]:
+                self.retire_executor(e)
+
+    def get_max_executors(self):
+        limit = self.dispatcher.configstore.get('middleware.max_executors')
+        return MAX_EXECUTORS if limit is None else limit
+
+    def add_executor(self):
+        executor = TaskExecutor(self, next(self.executor_index))
+        self.executors.append(executor)
+        self.executors_by_key[executor.key] = executor
+        return executor
+
+    def retire_executor(self, executor):
+        with executor.cv:
+            # Might have been assigned a task in the meantime
+            if executor.state != WorkerState.IDLE:
+                return
+
+            executor.state = WorkerState.EXITING
+
+        self.logger.info('Retiring idle task executor #{0}'.format(executor.index))
+        self.executors.remove(executor)
+        self.executors_by_key.pop(executor.key, None)
+        self.executors_by_conn.pop(executor.conn, None)
+        executor.die()
+
     def dispose_executors(self):
         for i in self.executors:
             i.die()
@@ -837,22 +1036,22 @@ class Balancer(object):
         if type is None:
             return self.task_list
 
+        if type == TaskState.WAITING:
+            return list(self.waiting_tasks)
+
+        if type == TaskState.EXECUTING:
+            return list(self.executing_tasks)
+
         return [x for x in self.task_list if x.state == type]
 
     def get_task(self, id):
-        self.distribution_lock.acquire()
-        t = first_or_default(lambda x: x.id == id, self.task_list)
-        if not t:
-            t = first_or_default(lambda x: x.id == id, self.task_queue.queue)
-
-        self.distribution_lock.release()
-        return t
+        return self.tasks_by_id.get(id)
 
     def get_executor_by_key(self, key):
-        return first_or_default(lambda t: t.key == key, self.executors)
+        return self.executors_by_key.get(key)
 
     def get_executor_by_sender(self, sender):
-        return first_or_default(lambda t: t.conn == sender, self.executors)
+        return self.executors_by_conn.get(sender)
 
     def update_executor_environment(self, env):
         for e in self.executors:
@@ -860,10 +1059,19 @@ class Balancer(object):
 
 
 def serialize_error(err):
+    try:
+        stacktrace = err.stacktrace
+    except AttributeError:
+        # Use the exception's own traceback rather than whatever is currently being handled
+        if err.__traceback__:
+            stacktrace = ''.join(traceback.format_exception(type(err), err, err.__traceback__))
+        else:
+            stacktrace = ''
+
     ret = {
         'type': type(err).__name__,
         'message': str(err),
-        'stacktrace': err.stacktrace if hasattr(err, 'stacktrace') else traceback.format_exc()
+        'stacktrace': stacktrace
     }
 
     if isinstance(err, RpcException):
@@ -877,13 +1085,64 @@ def serialize_error(err):
     return ret
 
 
+def copy_args(obj):
+    # Fast path for JSON-shaped arguments, deepcopy is used only for anything else
+    if type(obj) is dict:
+        return {k: copy_args(v) for k, v in obj.items()}
+
+    if type(obj) is list:
+        return [copy_args(x) for x in obj]
+
+    if type(obj) is tuple:
+        return tuple(copy_args(x) for x in obj)
+
+    if obj is None or type(obj) in (str, int, float, bool):
+        return obj
+
+    return copy.deepcopy(obj)
+
+
 def replace_invalid_chars(s):
     s = s.replace('.', '+')
     s = s.replace('$', '%')
     return s
 
 
+def needs_rewrite(obj):
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, (FileDescriptor, Password, tuple)):
+            return True
+
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                if '.' in k or '$' in k:
+                    return True
+
+                stack.append(v)
+
+            continue
+
+        if isinstance(obj, list):
+            stack.extend(obj)
+            continue
+
+        if isinstance(obj, int) and obj > 2**32:
+            return True
+
+    return False
+
+
 def remove_dots(obj):
+    # Most task args and results need no rewriting at all, so avoid copying them
+    if not needs_rewrite(obj):
+        return obj
+
+    return rewrite_dots(obj)
+
+
+def rewrite_dots(obj):
     if isinstance(obj, FileDescriptor):
         return {'fd': obj.fd}
 
@@ -891,10 +1150,10 @@ def remove_dots(obj):
         return str(obj)
 
     if isinstance(obj, dict):
-        return {replace_invalid_chars(k): remove_dots(v) for k, v in obj.items()}
+        return {replace_invalid_chars(k): rewrite_dots(v) for k, v in obj.items()}
 
     if isinstance(obj, (list, tuple)):
-        return [remove_dots(x) for x in obj]
+        return [rewrite_dots(x) for x in obj]
 
     if isinstance(obj, int) and obj > 2**32:
         return str(obj)
@@ -25,6 +25,8 @@
 #
 #####################################################################
 
+import os
+import shutil
 import logging
 import subprocess
 from freenas.utils.trace_logger import TRACE
@@ -40,12 +42,32 @@ class SubprocessException(Exception):
         self.err = err
 
 
+_which_cache = {}
+
+
+def which(name):
+    # Only successful lookups are remembered, and a remembered path is dropped once it stops
+    # being executable, so binaries installed, removed or moved later are still found
+    path = _which_cache.get(name)
+    if path and os.access(path, os.X_OK):
+        return path
+
+    path = shutil.which(name)
+    if path:
+        _which_cache[name] = path
+    else:
+        _which_cache.pop(name, None)
+
+    return path
+
+
 def system(*args, **kwargs):
     sh = kwargs.pop("shell", False)
     decode = kwargs.pop('decode', True)
     stdin = kwargs.pop('stdin', None)
     merge_stderr = kwargs.pop('merge_stderr', False)
     file_obj_stdin = kwargs.pop('file_obj_stdin', False)
+    bufsize = kwargs.pop('bufsize', -1)
 
     if stdin:
         stdin_data = stdin.encode('utf-8')
@@ -60,31 +82,45 @@ def system(*args, **kwargs):
         stdin_data = None
 
 
+    # Resolve bare command names through PATH only once per process
+    executable = None
+    if not sh and args and not os.path.isabs(args[0]):
+        executable = which(args[0])
+
     proc = subprocess.Popen(
-        [a.encode('utf-8') for a in args],
+        tuple(a.encode('utf-8') for a in args),
+        executable=executable,
         stdin=stdin,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT if merge_stderr else subprocess.PIPE,
         close_fds=True,
-        shell=sh
+        shell=sh,
+        bufsize=bufsize
     )
 
     out, err = proc.communicate(input=stdin_data)
-    logger.log(TRACE, "Running command: %s", ' '.join(args))
+    trace = logger.isEnabledFor(TRACE)
+    if trace:
+        cmdline = ' '.join(args)
+        logger.log(TRACE, "Running command: %s", cmdline)
 
     if decode:
-        out = out.decode('utf-8')
+        # decode may also name the codec, e.g. 'ascii' for outputs known to be plain ASCII
+        encoding = 'utf-8' if decode is True else decode
+        out = out.decode(encoding)
         if err:
-            err = err.decode('utf-8')
+            err = err.decode(encoding)
 
     if proc.returncode != 0:
-        logger.log(
-            TRACE,
-            "Command %s failed, return code %d, stderr output: %s",
-            ' '.join(args),
-            proc.returncode,
-            err or out
-        )
+        if trace:
+            logger.log(
+                TRACE,
+                "Command %s failed, return code %d, stderr output: %s",
+                cmdline,
+                proc.returncode,
+                err or out
+            )
+
         raise SubprocessException(proc.returncode, out, err)
 
     return out, err
@@ -397,6 +397,7 @@ class Dispatcher(object):
         self.register_event_type('server.service_logout')
         self.register_event_type('server.plugin.load_error')
         self.register_event_type('server.plugin.loaded')
+        self.register_event_type('server.logging_level.changed')
         self.register_event_type('server.ready')
         self.register_event_type('server.shutdown')
         self.register_event_type('server.schema_document_changed')
@@ -469,6 +470,9 @@ class Dispatcher(object):
         # And look for new ones
         self.discover_plugins()
 
+        # Task classes and schemas might have changed
+        self.balancer.validators.clear()
+
     def unload_plugins(self):
         # Generate a list of inverse plugin dependency
         required_by = {}
@@ -552,6 +556,7 @@ class Dispatcher(object):
         if not log_level:
             raise RpcException(errno.EINVAL, 'Invalid logging level {0} selected'.format(level))
         logging.root.setLevel(log_level)
+        self.dispatch_event('server.logging_level.changed', {'level': level})
 
     def dispatch_event(self, name, args):
         self.logger.log(TRACE, 'Dispatching event: name={0} args={1}'.format(name, args))
@@ -487,7 +487,10 @@ class TaskService(RpcService):
         if not executor:
             raise RpcException(errno.EPERM, 'Not authorized')
 
-        return executor.checkin(sender)
+        executor.checkin(sender)
+
+        # Let the worker preload plugins providing tasks
+        return [p.filename for p in self.__dispatcher.plugins.values() if p.registers['task_handlers']]
 
     @private
     @pass_sender
@@ -31,7 +31,6 @@ import logging
 from freenas.dispatcher.rpc import RpcService, RpcException, RpcWarning, convert_schema
 from freenas.utils import exclude
 from threading import RLock
-import collections
 
 
 class TaskState(object):
@@ -82,13 +81,19 @@ class Task(object):
 
     @classmethod
     def _get_metadata(cls):
-        return {
-            'description': getattr(cls, 'description', None),
-            'schema': cls._get_schema(),
-            'abortable': True if (hasattr(cls, 'abort') and isinstance(cls.abort, collections.Callable)) else False,
-            'private': getattr(cls, 'private', False),
-            'metadata': getattr(cls, 'metadata', None)
-        }
+        # Computed lazily and stored on the class itself, because decorators like
+        # @description or @accepts are applied after the class has been created
+        metadata = cls.__dict__.get('_metadata')
+        if metadata is None:
+            metadata = cls._metadata = {
+                'description': getattr(cls, 'description', None),
+                'schema': cls._get_schema(),
+                'abortable': callable(getattr(cls, 'abort', None)),
+                'private': getattr(cls, 'private', False),
+                'metadata': getattr(cls, 'metadata', None)
+            }
+
+        return metadata
 
     @classmethod
     def early_describe(cls):
@@ -228,7 +233,7 @@ class ValidationException(VerifyException):
         if other.extra:
             for err in other.extra:
                 if err['path'][:len(src_path)] == src_path:
-                    new_err = copy.deepcopy(err)
+                    new_err = dict(err)
                     new_err['path'] = dst_path + err['path'][len(src_path):]
                     self.extra.append(new_err)
         else:
@@ -307,34 +312,37 @@ def metadata(**d):
     return wrapped
 
 
-def query(result_type):
-    def wrapped(fn):
-        fn.params_schema = [
-            {
-                'title': 'filter',
+QUERY_PARAMS_SCHEMA = [
+    {
+        'title': 'filter',
+        'type': 'array',
+        'items': {
+            'type': 'array',
+            'minItems': 2,
+            'maxItems': 4
+        }
+    },
+    {
+        'title': 'options',
+        'type': 'object',
+        'properties': {
+            'sort': {
                 'type': 'array',
-                'items': {
-                    'type': 'array',
-                    'minItems': 2,
-                    'maxItems': 4
-                }
+                'items': {'type': 'string'}
             },
-            {
-                'title': 'options',
-                'type': 'object',
-                'properties': {
-                    'sort': {
-                        'type': 'array',
-                        'items': {'type': 'string'}
-                    },
-                    'limit': {'type': 'integer'},
-                    'offset': {'type': 'integer'},
-                    'single': {'type': 'boolean'},
-                    'count': {'type': 'boolean'}
-                }
-            }
-        ]
+            'limit': {'type': 'integer'},
+            'offset': {'type': 'integer'},
+            'single': {'type': 'boolean'},
+            'count': {'type': 'boolean'}
+        }
+    }
+]
 
+
+def query(result_type):
+    def wrapped(fn):
+        # Each method gets its own copy, so changing one method's schema cannot affect the others
+        fn.params_schema = copy.deepcopy(QUERY_PARAMS_SCHEMA)
         fn.result_schema = {
             'anyOf': [
                 {
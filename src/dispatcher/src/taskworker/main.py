@@ -28,14 +28,16 @@
 
 import os
 import sys
+import time
 import errno
 import socket
 import traceback
 import logging
 import queue
+import itertools
 import contextlib
 from bsd import setproctitle
-from threading import Event
+from threading import Event, Lock, Thread
 from freenas.dispatcher.client import Client
 from freenas.dispatcher.fd import FileDescriptor
 from freenas.dispatcher.rpc import RpcService, RpcException, RpcWarning
@@ -44,9 +46,16 @@ from datastore import get_datastore
 from datastore.config import ConfigStore
 
 
-def serialize_error(err):
-    etype, evalue, tb = sys.exc_info()
-    stacktrace = serialize_traceback(tb or traceback.extract_stack())
+PROGRESS_FLUSH_INTERVAL = 0.05
+logger = logging.getLogger('taskworker')
+
+
+def serialize_error(err, stacktrace=True):
+    if stacktrace:
+        etype, evalue, tb = sys.exc_info()
+        stacktrace = serialize_traceback(tb or traceback.extract_stack())
+    else:
+        stacktrace = None
 
     ret = {
         'type': type(err).__name__,
@@ -67,10 +76,13 @@ def serialize_error(err):
 
 class DispatcherWrapper(object):
     def __init__(self, context):
+        self.context = context
         self.dispatcher = context.conn
         self.datastore = context.datastore
         self.datastore_log = context.datastore_log
         self.configstore = context.configstore
+        self.dispatch_event = context.conn.emit_event
+        self.last_progress = None
 
     def run_hook(self, name, args):
         return self.dispatcher.call_sync('task.run_hook', name, args, timeout=300)
@@ -88,10 +100,17 @@ class DispatcherWrapper(object):
         return self.dispatcher.call_sync('task.abort_subtask', id, timeout=60)
 
     def add_warning(self, warning):
-        self.dispatcher.call_sync('task.put_warning', serialize_error(warning))
+        # Warnings are not raised, so there is no meaningful stack to capture
+        self.dispatcher.call_sync('task.put_warning', serialize_error(warning, stacktrace=False))
 
     def put_progress(self, progress):
-        self.dispatcher.call_sync('task.put_progress', progress.__getstate__())
+        # Push progress only when it actually changed
+        state = progress.__getstate__()
+        if state == self.last_progress:
+            return
+
+        self.last_progress = state
+        self.context.put_progress(state)
 
     def register_resource(self, resource, parents):
         self.dispatcher.call_sync('task.register_resource', resource.name, parents)
@@ -109,9 +128,6 @@ class DispatcherWrapper(object):
         self.dispatcher.call_sync('task.task_setenv', tid, key, value)
 
     def __getattr__(self, item):
-        if item == 'dispatch_event':
-            return self.dispatcher.emit_event
-
         return getattr(self.dispatcher, item)
 
 
@@ -147,9 +163,16 @@ class Context(object):
         self.datastore_log = None
         self.configstore = None
         self.conn = None
+        self.dispatcher = None
         self.instance = None
         self.module_cache = {}
+        self.module_lock = Lock()
         self.running = Event()
+        self.log_level = logging.DEBUG
+        self.progress_lock = Lock()
+        self.send_lock = Lock()
+        self.progress_ready = Event()
+        self.pending_progress = None
 
     def put_status(self, state, result=None, exception=None):
         obj = {
@@ -163,34 +186,95 @@ class Context(object):
         if exception is not None:
             obj['error'] = serialize_error(exception)
 
-        self.conn.call_sync('task.put_status', obj)
+        with self.send_lock:
+            # Pending progress is stale once the status changes
+            with self.progress_lock:
+                self.pending_progress = None
+
+            self.conn.call_sync('task.put_status', obj)
+
+    def put_progress(self, progress):
+        with self.progress_lock:
+            self.pending_progress = progress
+
+        self.progress_ready.set()
+
+    def progress_flusher(self):
+        # Send only the latest progress update every PROGRESS_FLUSH_INTERVAL
+        while True:
+            self.progress_ready.wait()
+            time.sleep(PROGRESS_FLUSH_INTERVAL)
+            self.progress_ready.clear()
+
+            # progress_lock only guards the swap, so put_progress() never waits on the RPC below.
+            # send_lock keeps a stale update from overtaking put_status().
+            with self.send_lock:
+                with self.progress_lock:
+                    progress, self.pending_progress = self.pending_progress, None
+
+                if not progress:
+                    continue
+
+                try:
+                    self.conn.call_sync('task.put_progress', progress)
+                except Exception as err:
+                    logger.warning('Cannot send task progress: %s', str(err), exc_info=True)
+
+    def logging_level_handler(self, args):
+        self.log_level = args['level']
+        logging.root.setLevel(self.log_level)
 
     def task_progress_handler(self, args):
         if self.instance:
             self.instance.task_progress_handler(args)
 
     def collect_fds(self, obj):
-        if isinstance(obj, dict):
-            for v in obj.values():
-                if isinstance(v, FileDescriptor):
-                    yield v
-                else:
-                    yield from self.collect_fds(v)
-
-        if isinstance(obj, (list, tuple)):
-            for o in obj:
-                if isinstance(o, FileDescriptor):
-                    yield o
-                else:
-                    yield from self.collect_fds(o)
+        fds = []
+        stack = [obj]
+        while stack:
+            obj = stack.pop()
+            if isinstance(obj, FileDescriptor):
+                fds.append(obj)
+            elif isinstance(obj, dict):
+                stack.extend(obj.values())
+            elif isinstance(obj, (list, tuple)):
+                stack.extend(obj)
+
+        return fds
 
     def close_fds(self, fds):
-        for i in fds:
+        # Close contiguous runs of descriptors with a single closerange() call
+        numbers = sorted(set(i.fd for i in fds))
+        for _, run in itertools.groupby(enumerate(numbers), lambda x: x[1] - x[0]):
+            run = [fd for _, fd in run]
+            if len(run) > 1:
+                os.closerange(run[0], run[-1] + 1)
+                continue
+
             try:
-                os.close(i.fd)
+                os.close(run[0])
             except OSError:
                 pass
 
+    def load_module(self, filename):
+        with self.module_lock:
+            mtime = os.stat(filename).st_mtime_ns
+            cached = self.module_cache.get(filename)
+            if cached and cached[0] == mtime:
+                return cached[1]
+
+            name, _ = os.path.splitext(os.path.basename(filename))
+            module = load_module_from_file(name, filename)
+            self.module_cache[filename] = (mtime, module)
+            return module
+
+    def preload_modules(self, filenames):
+        for i in filenames:
+            try:
+                self.load_module(i)
+            except BaseException as err:
+                print("Cannot preload module {0}: {1}".format(i, str(err)), file=sys.stderr)
+
     def run_task_hooks(self, instance, task, type, **extra_env):
         for hook, props in task['hooks'].get(type, {}).items():
             try:
@@ -202,6 +286,54 @@ class Context(object):
 
             instance.join_subtasks(instance.run_subtask(hook, *task['args'], **extra_env))
 
+    def run_task(self, task):
+        logging.root.setLevel(self.log_level)
+        setproctitle('task executor (tid {0})'.format(task['id']))
+
+        if task['debugger']:
+            sys.path.append('/usr/local/lib/dispatcher/pydev')
+
+            import pydevd
+            host, port = task['debugger']
+            pydevd.settrace(host, port=port, stdoutToServer=True, stderrToServer=True)
+
+        module = self.load_module(task['filename'])
+
+        setproctitle('task executor (tid {0})'.format(task['id']))
+        fds = self.collect_fds(task['args'])
+
+        try:
+            self.dispatcher.last_progress = None
+            self.instance = getattr(module, task['class'])(self.dispatcher)
+            self.instance.user = task['user']
+            self.instance.environment = task['environment']
+            self.running.set()
+            self.run_task_hooks(self.instance, task, 'before')
+            result = self.instance.run(*task['args'])
+            self.run_task_hooks(self.instance, task, 'after', result=result)
+        except BaseException as err:
+            print("Task exception: {0}".format(str(err)), file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+
+            if hasattr(self.instance, 'rollback'):
+                self.put_status('ROLLBACK')
+                try:
+                    self.instance.rollback(*task['args'])
+                except BaseException as rerr:
+                    print("Task exception during rollback: {0}".format(str(rerr)), file=sys.stderr)
+                    traceback.print_exc(file=sys.stderr)
+
+            # Main task is already failed at this point, so ignore hook errors
+            with contextlib.suppress(RpcException):
+                self.run_task_hooks(self.instance, task, 'error', error=serialize_error(err))
+
+            self.put_status('FAILED', exception=err)
+        else:
+            self.put_status('FINISHED', result=result)
+        finally:
+            self.close_fds(fds)
+            self.running.clear()
+
     def main(self):
         if len(sys.argv) != 3:
             print("Invalid number of arguments", file=sys.stderr)
@@ -221,63 +353,18 @@ class Context(object):
         self.conn.call_sync('management.enable_features', ['streaming_responses'])
         self.conn.rpc.register_service_instance('taskproxy', self.service)
         self.conn.register_event_handler('task.progress', self.task_progress_handler)
-        self.conn.call_sync('task.checkin', key)
+        self.conn.register_event_handler('server.logging_level.changed', self.logging_level_handler)
+        self.log_level = self.conn.call_sync('management.get_logging_level')
+        self.dispatcher = DispatcherWrapper(self)
+        modules = self.conn.call_sync('task.checkin', key)
+        Thread(target=self.progress_flusher, daemon=True).start()
+        Thread(target=self.preload_modules, args=(modules or [],), daemon=True).start()
         setproctitle('task executor (idle)')
 
         while True:
+            task = self.task.get()
             try:
-                task = self.task.get()
-                logging.root.setLevel(self.conn.call_sync('management.get_logging_level'))
-                setproctitle('task executor (tid {0})'.format(task['id']))
-
-                if task['debugger']:
-                    sys.path.append('/usr/local/lib/dispatcher/pydev')
-
-                    import pydevd
-                    host, port = task['debugger']
-                    pydevd.settrace(host, port=port, stdoutToServer=True, stderrToServer=True)
-
-                name, _ = os.path.splitext(os.path.basename(task['filename']))
-                module = self.module_cache.get(task['filename'])
-                if not module:
-                    module = load_module_from_file(name, task['filename'])
-                    self.module_cache[task['filename']] = module
-
-                setproctitle('task executor (tid {0})'.format(task['id']))
-                fds = list(self.collect_fds(task['args']))
-
-                try:
-                    dispatcher = DispatcherWrapper(self)
-                    self.instance = getattr(module, task['class'])(dispatcher)
-                    self.instance.user = task['user']
-                    self.instance.environment = task['environment']
-                    self.running.set()
-                    self.run_task_hooks(self.instance, task, 'before')
-                    result = self.instance.run(*task['args'])
-                    self.run_task_hooks(self.instance, task, 'after', result=result)
-                except BaseException as err:
-                    print("Task exception: {0}".format(str(err)), file=sys.stderr)
-                    traceback.print_exc(file=sys.stderr)
-
-                    if hasattr(self.instance, 'rollback'):
-                        self.put_status('ROLLBACK')
-                        try:
-                            self.instance.rollback(*task['args'])
-                        except BaseException as rerr:
-                            print("Task exception during rollback: {0}".format(str(rerr)), file=sys.stderr)
-                            traceback.print_exc(file=sys.stderr)
-
-                    # Main task is already failed at this point, so ignore hook errors
-                    with contextlib.suppress(RpcException):
-                        self.run_task_hooks(self.instance, task, 'error', error=serialize_error(err))
-
-                    self.put_status('FAILED', exception=err)
-                else:
-                    self.put_status('FINISHED', result=result)
-                finally:
-                    self.close_fds(fds)
-                    self.running.clear()
-
+                self.run_task(task)
             except RpcException as err:
                 print("RPC failed: {0}".format(str(err)), file=sys.stderr)
                 print(traceback.format_exc(), flush=True)
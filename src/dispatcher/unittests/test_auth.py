@@ -0,0 +1,91 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import unittest
+from unittest import mock
+
+import auth
+
+
+class TestUserCache(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(auth.time, 'monotonic', return_value=1000.0)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = auth.UserCache(maxsize=3, ttl=10)
+
+    def test_get(self):
+        self.cache['alice'] = 'a'
+        self.assertEqual(self.cache.get('alice'), 'a')
+        self.assertIn('alice', self.cache)
+        self.assertIsNone(self.cache.get('bob'))
+        self.assertEqual(self.cache.get('bob', 'default'), 'default')
+
+    def test_evicts_least_recently_used(self):
+        for name in ('a', 'b', 'c'):
+            self.cache[name] = name
+
+        # Touching 'a' makes 'b' the least recently used entry
+        self.cache.get('a')
+        self.cache['d'] = 'd'
+
+        self.assertEqual(len(self.cache), 3)
+        self.assertNotIn('b', self.cache)
+        for name in ('a', 'c', 'd'):
+            self.assertIn(name, self.cache)
+
+    def test_overwrite_refreshes(self):
+        for name in ('a', 'b', 'c'):
+            self.cache[name] = name
+
+        self.cache['a'] = 'new'
+        self.cache['d'] = 'd'
+
+        self.assertEqual(self.cache.get('a'), 'new')
+        self.assertNotIn('b', self.cache)
+
+    def test_expires_after_ttl(self):
+        self.cache['alice'] = 'a'
+        self.clock.return_value = 1009.0
+        self.assertEqual(self.cache.get('alice'), 'a')
+
+        self.clock.return_value = 1011.0
+        self.assertIsNone(self.cache.get('alice'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_pop_and_clear(self):
+        self.cache['alice'] = 'a'
+        self.cache['bob'] = 'b'
+
+        self.assertEqual(self.cache.pop('alice'), 'a')
+        self.assertIsNone(self.cache.pop('alice'))
+        self.cache.clear()
+        self.assertEqual(len(self.cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import unittest
+
+from freenas.dispatcher import Password
+from freenas.dispatcher.fd import FileDescriptor
+from balancer import copy_args, needs_rewrite, remove_dots, rewrite_dots
+
+
+class Opaque(object):
+    def __init__(self, value):
+        self.value = value
+
+
+class TestCopyArgs(unittest.TestCase):
+    def test_copies_containers(self):
+        args = [{'name': 'foo', 'props': {'a': [1, 2]}}, ('x', ['y'])]
+        copied = copy_args(args)
+
+        self.assertEqual(copied, args)
+        self.assertIsNot(copied[0], args[0])
+        self.assertIsNot(copied[0]['props']['a'], args[0]['props']['a'])
+        self.assertIsInstance(copied[1], tuple)
+        self.assertIsNot(copied[1][1], args[1][1])
+
+        copied[0]['props']['a'].append(3)
+        self.assertEqual(args[0]['props']['a'], [1, 2])
+
+    def test_scalars(self):
+        for i in (None, 'str', 1, 1.5, True):
+            self.assertIs(copy_args(i), i)
+
+    def test_deepcopies_other_objects(self):
+        obj = Opaque([1])
+        copied = copy_args({'obj': obj})['obj']
+
+        self.assertIsNot(copied, obj)
+        self.assertIsNot(copied.value, obj.value)
+        self.assertEqual(copied.value, [1])
+
+
+class TestNeedsRewrite(unittest.TestCase):
+    def test_plain_data(self):
+        obj = {'name': 'foo', 'list': [1, 'a', {'nested': None}], 'big': 2**32}
+        self.assertFalse(needs_rewrite(obj))
+        self.assertIs(remove_dots(obj), obj)
+
+    def test_keys(self):
+        self.assertTrue(needs_rewrite({'a.b': 1}))
+        self.assertTrue(needs_rewrite({'$a': 1}))
+        self.assertTrue(needs_rewrite([{'ok': [{'deep.key': 1}]}]))
+
+    def test_values(self):
+        self.assertTrue(needs_rewrite([1, (2, 3)]))
+        self.assertTrue(needs_rewrite({'n': 2**32 + 1}))
+        self.assertTrue(needs_rewrite({'p': Password('secret')}))
+        self.assertTrue(needs_rewrite([FileDescriptor(3)]))
+
+    def test_remove_dots_rewrites(self):
+        obj = {'a.b': [(1, 2**33)], 'c': 'd'}
+        self.assertEqual(remove_dots(obj), rewrite_dots(obj))
+        self.assertEqual(remove_dots(obj), {'a+b': [[1, str(2**33)]], 'c': 'd'})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+######################################################################
+
+import os
+import unittest
+import importlib.util
+
+spec = importlib.util.spec_from_file_location(
+    'taskworker',
+    os.path.join(os.path.dirname(__file__), '..', 'src', 'taskworker', 'main.py')
+)
+taskworker = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(taskworker)
+
+
+class FakeFileDescriptor(object):
+    def __init__(self, fd):
+        self.fd = fd
+
+
+def is_open(fd):
+    try:
+        os.fstat(fd)
+        return True
+    except OSError:
+        return False
+
+
+class TestCloseFds(unittest.TestCase):
+    BASE = 200
+
+    def setUp(self):
+        self.context = taskworker.Context()
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        self.addCleanup(os.close, w)
+        self.source = r
+
+    def tearDown(self):
+        for fd in range(self.BASE, self.BASE + 20):
+            if is_open(fd):
+                os.close(fd)
+
+    def make_fds(self, *offsets):
+        fds = [self.BASE + i for i in offsets]
+        for fd in fds:
+            os.dup2(self.source, fd)
+
+        return fds
+
+    def test_contiguous_run(self):
+        fds = self.make_fds(0, 1, 2, 3)
+        self.context.close_fds([FakeFileDescriptor(i) for i in fds])
+        self.assertFalse(any(is_open(i) for i in fds))
+
+    def test_runs_with_gaps(self):
+        passed = self.make_fds(0, 1, 3, 5, 6, 9)
+        kept = self.make_fds(2, 4, 7, 8)
+
+        # Unsorted, with duplicates, as collected from nested task arguments
+        self.context.close_fds([FakeFileDescriptor(i) for i in reversed(passed + passed[:2])])
+
+        self.assertFalse(any(is_open(i) for i in passed))
+        self.assertTrue(all(is_open(i) for i in kept))
+
+    def test_already_closed(self):
+        fds = self.make_fds(0, 2)
+        os.close(fds[0])
+        self.context.close_fds([FakeFileDescriptor(i) for i in fds])
+        self.assertFalse(is_open(fds[1]))
+
+    def test_empty(self):
+        self.context.close_fds([])
+
+
+if __name__ == '__main__':
+    unittest.main()
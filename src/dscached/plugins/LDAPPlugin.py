@@ -25,10 +25,16 @@
 #
 #####################################################################
 
+import copy
+import time
 import errno
 import uuid
+import collections
+import itertools
 import ldap3
 import ldap3.utils.dn
+from ldap3.core.exceptions import LDAPException
+from ldap3.utils.conv import escape_filter_chars
 import logging
 import threading
 import ssl
@@ -38,13 +44,52 @@ from plugin import DirectoryServicePlugin, DirectoryState
 from utils import LdapQueryBuilder, obtain_or_renew_ticket, join_dn, dn_to_domain, domain_to_dn, uuid2, parse_uuid2
 from utils import crc32
 from freenas.utils import first_or_default, normalize
-from freenas.utils.query import get, contains
 
 
 TICKET_RENEW_LIFE = 30 * 86400  # 30 days
+BIND_CHECK_INTERVAL = 60
+ENUMERATION_CACHE_TTL = 5
+ENUMERATION_CACHE_SIZE = 1000
+SEARCH_PAGE_SIZE = 500
+USER_ATTRIBUTES = [
+    'uid', 'uidNumber', 'gidNumber', 'gecos', 'displayName', 'loginShell',
+    'sambaSID', 'sambaNTPassword', 'sambaLMPassword', 'sambaPwdLastSet'
+]
+GROUP_ATTRIBUTES = ['cn', 'gidNumber', 'sambaSID', 'memberUid']
+DEFAULT_PARAMETERS = {
+    '%type': 'LdapDirectoryParams',
+    'user_suffix': 'ou=users',
+    'group_suffix': 'ou=groups',
+    'krb_principal': None,
+    'encryption': 'OFF',
+    'certificate': None,
+    'verify_certificate': True
+}
 logger = logging.getLogger(__name__)
 
 
+def escape(value):
+    return escape_filter_chars(str(value))
+
+
+def first(entry, name, default=None):
+    # ldap3 returns multi-valued attributes as lists and single-valued ones as plain values
+    value = entry.get(name)
+    if isinstance(value, list):
+        return value[0] if value else default
+
+    return default if value is None else value
+
+
+class PendingLookup(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
 class LDAPPlugin(DirectoryServicePlugin):
     def __init__(self, context):
         self.context = context
@@ -54,9 +99,15 @@ class LDAPPlugin(DirectoryServicePlugin):
         self.conn = None
         self.parameters = None
         self.base_dn = None
+        self.base_domain = None
+        self.base_checksum = None
         self.user_dn = None
         self.group_dn = None
         self.start_tls = False
+        self.enumeration_cache = {}
+        self.enumeration_lock = threading.Lock()
+        self.pending_lookups = {}
+        self.pending_lookups_lock = threading.Lock()
         self.bind_lock = threading.RLock()
         self.bind_thread = threading.Thread(target=self.bind, daemon=True)
         self.cv = threading.Condition()
@@ -64,77 +115,186 @@ class LDAPPlugin(DirectoryServicePlugin):
 
     @classmethod
     def normalize_parameters(cls, parameters):
-        return normalize(parameters, {
-            '%type': 'LdapDirectoryParams',
-            'user_suffix': 'ou=users',
-            'group_suffix': 'ou=groups',
-            'krb_principal': None,
-            'encryption': 'OFF',
-            'certificate': None,
-            'verify_certificate': True
-        })
+        return normalize(parameters, DEFAULT_PARAMETERS)
 
-    def search(self, search_base, search_filter, attributes=None):
+    def search_async(self, search_base, search_filter, attributes=None):
         if self.conn.closed:
             with self.bind_lock:
                 self.conn.bind()
 
-        id = self.conn.search(search_base, search_filter, attributes=attributes or ldap3.ALL_ATTRIBUTES)
+        return self.conn.search(search_base, search_filter, attributes=attributes or ldap3.ALL_ATTRIBUTES)
+
+    def get_response(self, id):
         result, status = self.conn.get_response(id)
         return result
 
+    def search(self, search_base, search_filter, attributes=None):
+        return self.get_response(self.search_async(search_base, search_filter, attributes))
+
     def search_one(self, *args, **kwargs):
         return first_or_default(None, self.search(*args, **kwargs))
 
+    def search_paged(self, search_base, search_filter, attributes=None):
+        # Yields entries page by page instead of collecting the whole result set first
+        if self.conn.closed:
+            with self.bind_lock:
+                self.conn.bind()
+
+        return self.conn.extend.standard.paged_search(
+            search_base=search_base,
+            search_filter=search_filter,
+            attributes=attributes or ldap3.ALL_ATTRIBUTES,
+            paged_size=SEARCH_PAGE_SIZE,
+            generator=True
+        )
+
+    def cached_enumeration(self, name, fetch):
+        # Back-to-back enumerations reuse the list fetched within the last ENUMERATION_CACHE_TTL seconds
+        with self.enumeration_lock:
+            cached = self.enumeration_cache.get(name)
+
+        if cached and time.monotonic() - cached[0] < ENUMERATION_CACHE_TTL:
+            return (copy.copy(i) for i in cached[1])
+
+        stream = []
+
+        def fill():
+            # Buffer at most ENUMERATION_CACHE_SIZE entries, larger enumerations are streamed and not cached
+            now = time.monotonic()
+            result = fetch()
+            head = list(itertools.islice(result, ENUMERATION_CACHE_SIZE + 1))
+            if len(head) > ENUMERATION_CACHE_SIZE:
+                stream.append(itertools.chain(head, result))
+                return None
+
+            with self.enumeration_lock:
+                self.enumeration_cache[name] = (now, head)
+
+            return head
+
+        entries = self.single_flight(('enumeration', name), fill)
+        if stream:
+            return stream[0]
+
+        if entries is None:
+            # Waited on a fill that turned out too large to cache, so stream our own
+            return fetch()
+
+        # Callers annotate returned entries in place, so hand out copies
+        return (copy.copy(i) for i in entries)
+
+    def single_flight(self, key, fetch):
+        # Concurrent lookups of the same key wait for a single LDAP query instead of issuing their own
+        with self.pending_lookups_lock:
+            lookup = self.pending_lookups.get(key)
+            owner = lookup is None
+            if owner:
+                lookup = self.pending_lookups[key] = PendingLookup()
+
+        if not owner:
+            lookup.done.wait()
+            if lookup.error:
+                raise lookup.error
+
+            return copy.copy(lookup.result)
+
+        try:
+            lookup.result = fetch()
+            return lookup.result
+        except BaseException as err:
+            lookup.error = err
+            raise
+        finally:
+            with self.pending_lookups_lock:
+                del self.pending_lookups[key]
+
+            lookup.done.set()
+
     def get_id(self, entry):
-        checksum = crc32(dn_to_domain(self.parameters['base_dn']))
+        checksum = self.base_checksum
 
         if 'entryUUID' in entry:
-            return get(entry, 'entryUUID')
+            return first(entry, 'entryUUID')
 
         if 'uidNumber' in entry:
-            return str(uuid2(checksum, int(get(entry, 'uidNumber'))))
+            return str(uuid2(checksum, int(first(entry, 'uidNumber'))))
 
         if 'gidNumber' in entry:
-            return str(uuid2(checksum, int(get(entry, 'gidNumber'))))
+            return str(uuid2(checksum, int(first(entry, 'gidNumber'))))
 
         return str(uuid.uuid4())
 
     def get_gecos(self, entry):
         pass
 
-    def convert_user(self, entry):
-        entry = dict(entry['attributes'])
-        pwd_change_time = get(entry, 'sambaPwdLastSet')
-        groups = []
-        group = None
-        username = get(entry, 'uid.0')
+    def request_groups(self, entry):
+        # Send primary and auxiliary group lookups together, so their round trips overlap
+        entry = entry['attributes']
+        primary_id = None
 
-        if contains(entry, 'gidNumber'):
-            ret = self.search_one(
+        if 'gidNumber' in entry:
+            primary_id = self.search_async(
                 self.group_dn,
-                '(gidNumber={0})'.format(get(entry, 'gidNumber'))
+                '(gidNumber={0})'.format(escape(first(entry, 'gidNumber'))),
+                GROUP_ATTRIBUTES
             )
 
-            if ret:
-                group = dict(ret['attributes'])
+        aux_id = self.search_async(self.group_dn, '(memberUid={0})'.format(escape(first(entry, 'uid'))), GROUP_ATTRIBUTES)
+        return primary_id, aux_id
+
+    def load_group_index(self):
+        # Fetch all groups at once and index them by gid and by member name
+        by_gid = {}
+        by_member = collections.defaultdict(list)
 
-        # Try to find any auxiliary groups
-        for i in self.search(self.group_dn, '(memberUid={0})'.format(get(entry, 'uid'))):
+        for i in self.search_paged(self.group_dn, '(objectclass=posixGroup)', GROUP_ATTRIBUTES):
             g = dict(i['attributes'])
-            groups.append(self.get_id(g))
+            if 'gidNumber' in g:
+                by_gid.setdefault(int(first(g, 'gidNumber')), g)
+
+            for member in g.get('memberUid') or []:
+                by_member[member].append(g)
+
+        return by_gid, by_member
+
+    def convert_user(self, entry, group_index=None):
+        if not group_index:
+            primary_id, aux_id = self.request_groups(entry)
+
+        entry = dict(entry['attributes'])
+        pwd_change_time = first(entry, 'sambaPwdLastSet')
+        groups = []
+        group = None
+        username = first(entry, 'uid')
+
+        if group_index:
+            by_gid, by_member = group_index
+            if 'gidNumber' in entry:
+                group = by_gid.get(int(first(entry, 'gidNumber')))
+
+            groups = [self.get_id(g) for g in by_member.get(username, [])]
+        else:
+            if primary_id is not None:
+                ret = first_or_default(None, self.get_response(primary_id))
+                if ret:
+                    group = dict(ret['attributes'])
+
+            # Try to find any auxiliary groups
+            for i in self.get_response(aux_id):
+                g = dict(i['attributes'])
+                groups.append(self.get_id(g))
 
         return {
             'id': self.get_id(entry),
-            'sid': get(entry, 'sambaSID'),
-            'uid': int(get(entry, 'uidNumber')),
+            'sid': first(entry, 'sambaSID'),
+            'uid': int(first(entry, 'uidNumber')),
             'builtin': False,
             'username': username,
-            'full_name': get(entry, 'gecos', get(entry, 'displayName')) or '<unknown>',
-            'shell': get(entry, 'loginShell', '/bin/sh'),
+            'full_name': first(entry, 'gecos') or first(entry, 'displayName') or '<unknown>',
+            'shell': first(entry, 'loginShell', '/bin/sh'),
             'home': self.context.get_home_directory(self.directory, username),
-            'nthash': get(entry, 'sambaNTPassword'),
-            'lmhash': get(entry, 'sambaLMPassword'),
+            'nthash': first(entry, 'sambaNTPassword'),
+            'lmhash': first(entry, 'sambaLMPassword'),
             'password_changed_at': datetime.utcfromtimestamp(int(pwd_change_time)) if pwd_change_time else None,
             'group': self.get_id(group) if group else None,
             'groups': groups,
@@ -145,86 +305,116 @@ class LDAPPlugin(DirectoryServicePlugin):
         entry = dict(entry['attributes'])
         return {
             'id': self.get_id(entry),
-            'gid': int(get(entry, 'gidNumber')),
-            'sid': get(entry, 'sambaSID'),
-            'name': get(entry, 'cn.0'),
+            'gid': int(first(entry, 'gidNumber')),
+            'sid': first(entry, 'sambaSID'),
+            'name': first(entry, 'cn'),
             'builtin': False,
             'sudo': False
         }
 
     def getpwent(self, filter=None, params=None):
-        logger.debug('getpwent(filter={0}, params={0})'.format(filter, params))
-        result = self.search(self.user_dn, '(objectclass=posixAccount)')
-        return (self.convert_user(i) for i in result)
+        logger.debug('getpwent(filter=%s, params=%s)', filter, params)
+
+        def fetch():
+            group_index = self.load_group_index()
+            result = self.search_paged(self.user_dn, '(objectclass=posixAccount)', USER_ATTRIBUTES)
+            return (self.convert_user(i, group_index) for i in result)
+
+        return self.cached_enumeration('users', fetch)
 
     def getpwnam(self, name):
-        logger.debug('getpwnam(name={0})'.format(name))
-        result = self.search_one(self.user_dn, f'(&(objectclass=posixAccount)(uid={name}))')
-        return self.convert_user(result)
+        logger.debug('getpwnam(name=%s)', name)
+        return self.single_flight(('getpwnam', name), lambda: self.convert_user(self.search_one(
+            self.user_dn,
+            '(&(objectclass=posixAccount)(uid={0}))'.format(escape(name)),
+            USER_ATTRIBUTES
+        )))
 
     def getpwuid(self, uid):
-        logger.debug('getpwuid(uid={0})'.format(uid))
-        result = self.search_one(self.user_dn, f'(&(objectclass=posixAccount)(uidNumber={uid}))')
-        return self.convert_user(result)
+        logger.debug('getpwuid(uid=%s)', uid)
+        return self.single_flight(('getpwuid', uid), lambda: self.convert_user(self.search_one(
+            self.user_dn,
+            '(&(objectclass=posixAccount)(uidNumber={0}))'.format(escape(uid)),
+            USER_ATTRIBUTES
+        )))
 
     def getpwuuid(self, id):
-        logger.debug('getpwuuid(uuid={0})'.format(id))
+        logger.debug('getpwuuid(uuid=%s)', id)
 
         try:
             checksum, uid = parse_uuid2(id)
-            if crc32(dn_to_domain(self.base_dn)) != checksum:
+            if self.base_checksum != checksum:
                 return None
 
-            q = f'(uidNumber={uid})'
+            q = '(uidNumber={0})'.format(uid)
         except ValueError:
-            q = f'(entryUUID={id})'
+            q = '(entryUUID={0})'.format(escape(id))
 
-        user = self.search_one(self.user_dn, q)
+        user = self.search_one(self.user_dn, q, USER_ATTRIBUTES)
         return self.convert_user(user)
 
     def getgrent(self, filter=None, params=None):
-        logger.debug('getgrent(filter={0}, params={0})'.format(filter, params))
-        result = self.search(self.group_dn, '(objectclass=posixGroup)')
-        return (self.convert_group(i) for i in result)
+        logger.debug('getgrent(filter=%s, params=%s)', filter, params)
+
+        def fetch():
+            result = self.search_paged(self.group_dn, '(objectclass=posixGroup)', GROUP_ATTRIBUTES)
+            return (self.convert_group(i) for i in result)
+
+        return self.cached_enumeration('groups', fetch)
 
     def getgrnam(self, name):
-        logger.debug('getgrnam(name={0})'.format(name))
-        result = self.search_one(join_dn('cn={0}'.format(name), self.group_dn), '(objectclass=posixGroup)')
-        return self.convert_group(result)
+        logger.debug('getgrnam(name=%s)', name)
+        return self.single_flight(('getgrnam', name), lambda: self.convert_group(self.search_one(
+            self.group_dn,
+            '(&(objectclass=posixGroup)(cn={0}))'.format(escape(name)),
+            GROUP_ATTRIBUTES
+        )))
 
     def getgrgid(self, gid):
-        logger.debug('getgrgid(gid={0})'.format(gid))
-        result = self.search_one(self.group_dn, f'(&(objectclass=posixGroup)(gidNumber={gid}))')
-        return self.convert_group(result)
+        logger.debug('getgrgid(gid=%s)', gid)
+        return self.single_flight(('getgrgid', gid), lambda: self.convert_group(self.search_one(
+            self.group_dn,
+            '(&(objectclass=posixGroup)(gidNumber={0}))'.format(escape(gid)),
+            GROUP_ATTRIBUTES
+        )))
 
     def getgruuid(self, id):
-        logger.debug('getgruuid(uuid={0})'.format(id))
+        logger.debug('getgruuid(uuid=%s)', id)
 
         try:
             checksum, gid = parse_uuid2(id)
-            if crc32(dn_to_domain(self.base_dn)) != checksum:
+            if self.base_checksum != checksum:
                 return None
 
-            q = f'(gidNumber={gid})'
+            q = '(gidNumber={0})'.format(gid)
         except ValueError:
-            q = f'(entryUUID={id})'
+            q = '(entryUUID={0})'.format(escape(id))
 
-        group = self.search_one(self.group_dn, q)
+        group = self.search_one(self.group_dn, q, GROUP_ATTRIBUTES)
         return self.convert_group(group)
 
     def authenticate(self, user_name, password):
-        with self.bind_lock:
-            try:
-                self.conn.rebind(
-                    user=join_dn('uid={0}'.format(user_name), self.user_dn),
-                    password=password
-                )
-            except ldap3.LDAPBindError:
-                self.conn.bind()
-                return False
+        # An empty password would turn into an unauthenticated bind, which servers accept
+        if not password:
+            return False
+
+        # Verify credentials on a throwaway connection, so the shared one stays bound as the service account
+        probe = ldap3.Connection(
+            self.server,
+            user=join_dn('uid={0}'.format(user_name), self.user_dn),
+            password=password
+        )
+
+        try:
+            if self.start_tls:
+                probe.open()
+                probe.start_tls()
 
-            self.conn.bind()
-            return True
+            return probe.bind()
+        except LDAPException:
+            return False
+        finally:
+            probe.unbind()
 
     def configure(self, enable, directory):
         def create_server_args(params):
@@ -253,72 +443,92 @@ class LDAPPlugin(DirectoryServicePlugin):
             self.enabled = enable
             self.server = ldap3.Server(self.parameters['server'], **create_server_args(self.parameters))
             self.base_dn = self.parameters['base_dn']
+            self.base_domain = dn_to_domain(self.base_dn)
+            self.base_checksum = crc32(self.base_domain)
             self.user_dn = join_dn(self.parameters['user_suffix'], self.base_dn)
             self.group_dn = join_dn(self.parameters['group_suffix'], self.base_dn)
             self.start_tls = self.parameters['encryption'] == 'TLS'
+            with self.enumeration_lock:
+                self.enumeration_cache.clear()
+
             self.cv.notify_all()
 
-        return dn_to_domain(directory.parameters['base_dn'])
+        return self.base_domain
 
     def bind(self):
         while True:
             with self.cv:
-                notify = self.cv.wait(60)
-
-                if self.enabled:
-                    if self.parameters['krb_principal']:
-                        try:
-                            obtain_or_renew_ticket(
-                                self.principal,
-                                keytab=True,
-                                renew_life=TICKET_RENEW_LIFE
-                            )
-                        except krb5.KrbException as err:
-                            self.directory.put_status(errno.ENXIO, '{0} <{1}>'.format(str(err), type(err).__name__))
-                            self.directory.put_state(DirectoryState.FAILURE)
-                            continue
-
-                    if self.directory.state == DirectoryState.BOUND and not notify:
-                        continue
-
+                # While enabled, wake up periodically to renew the Kerberos ticket and to retry a failed bind
+                notify = self.cv.wait(BIND_CHECK_INTERVAL if self.enabled else None)
+                enabled = self.enabled
+                directory = self.directory
+                parameters = self.parameters
+                server = self.server
+                start_tls = self.start_tls
+
+            # Network I/O below runs without holding the condition, so configure() never waits on it
+            if enabled:
+                if parameters['krb_principal']:
                     try:
-                        self.directory.put_state(DirectoryState.JOINING)
-
-                        if self.parameters['krb_principal']:
-                            self.conn = ldap3.Connection(
-                                self.server,
-                                client_strategy='ASYNC',
-                                authentication=ldap3.SASL,
-                                sasl_mechanism='GSSAPI'
-                            )
-                        else:
-                            self.conn = ldap3.Connection(
-                                self.server,
-                                client_strategy='ASYNC',
-                                user=self.parameters['bind_dn'],
-                                password=self.parameters['password']
-                            )
-
-                            if self.start_tls:
-                                logger.debug('Performing STARTTLS...')
-                                self.conn.open()
-                                self.conn.start_tls()
-
-                        if not self.conn.bind():
-                            raise RuntimeError('Bind failed: wrong credentials')
-
-                        self.directory.put_state(DirectoryState.BOUND)
-                        continue
-                    except BaseException as err:
-                        self.directory.put_status(errno.ENXIO, '{0} <{1}>'.format(str(err), type(err).__name__))
-                        self.directory.put_state(DirectoryState.FAILURE)
+                        obtain_or_renew_ticket(
+                            parameters['krb_principal'],
+                            keytab=True,
+                            renew_life=TICKET_RENEW_LIFE
+                        )
+                    except krb5.KrbException as err:
+                        directory.put_status(errno.ENXIO, '{0} <{1}>'.format(str(err), type(err).__name__))
+                        directory.put_state(DirectoryState.FAILURE)
                         continue
-                else:
-                    if self.directory.state != DirectoryState.DISABLED:
-                        self.directory.put_state(DirectoryState.EXITING)
+
+                if directory.state == DirectoryState.BOUND and not notify:
+                    continue
+
+                try:
+                    directory.put_state(DirectoryState.JOINING)
+
+                    if parameters['krb_principal']:
+                        conn = ldap3.Connection(
+                            server,
+                            client_strategy='ASYNC',
+                            authentication=ldap3.SASL,
+                            sasl_mechanism='GSSAPI'
+                        )
+                    else:
+                        conn = ldap3.Connection(
+                            server,
+                            client_strategy='ASYNC',
+                            user=parameters['bind_dn'],
+                            password=parameters['password']
+                        )
+
+                        if start_tls:
+                            logger.debug('Performing STARTTLS...')
+                            conn.open()
+                            conn.start_tls()
+
+                    if not conn.bind():
+                        raise RuntimeError('Bind failed: wrong credentials')
+
+                    with self.bind_lock:
+                        self.conn = conn
+
+                    with self.enumeration_lock:
+                        self.enumeration_cache.clear()
+
+                    directory.put_state(DirectoryState.BOUND)
+                    continue
+                except BaseException as err:
+                    directory.put_status(errno.ENXIO, '{0} <{1}>'.format(str(err), type(err).__name__))
+                    directory.put_state(DirectoryState.FAILURE)
+                    continue
+            else:
+                if directory.state != DirectoryState.DISABLED:
+                    directory.put_state(DirectoryState.EXITING)
+                    if self.conn:
                         self.conn.unbind()
-                        self.directory.put_state(DirectoryState.DISABLED)
-                        continue
+
+                    directory.put_state(DirectoryState.DISABLED)
+                    continue
 
 
 def _init(context):
@@ -37,8 +37,10 @@ import subprocess
 import errno
 import time
 import contextlib
+import functools
 from typing import Optional
-from threading import Thread, Condition
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
 from datetime import datetime
 from plugin import DirectoryServicePlugin, DirectoryState, params, status
 from utils import domain_to_dn, join_dn, obtain_or_renew_ticket, have_ticket, get_srv_records, get_a_records
@@ -53,6 +55,13 @@ from freenas.utils.query import get
 AD_REALM_ID = uuid.UUID('01a35b82-0168-11e6-88d6-0cc47a3511b4')
 WINBINDD_PIDFILE = '/var/run/samba4/winbindd.pid'
 WINBINDD_KEEPALIVE = 60
+WINBINDD_KEEPALIVE_MAX = 600
+NET_TIMEOUT = 60
+NET_ADS_JOIN_TIMEOUT = 120
+TICKET_RENEW_INTERVAL = 3600
+SMB_RESTART_PARAMETERS = {'server role', 'security', 'workgroup', 'realm'}
+NEGATIVE_CACHE_TTL = 5
+NEGATIVE_CACHE_SIZE = 8192
 AD_LDAP_ATTRIBUTE_MAPPING = {
     'id': 'objectGUID',
     'sd': 'objectSid',
@@ -130,6 +139,25 @@ def yesno(val):
     return 'yes' if val else 'no'
 
 
+def call_net(*args):
+    # A hung net process must not stall the bind thread forever
+    try:
+        return subprocess.call(['/usr/local/bin/net'] + list(args), timeout=NET_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        logger.warning('net {0} timed out after {1} seconds'.format(' '.join(args), NET_TIMEOUT))
+
+
+@functools.lru_cache(maxsize=4096)
+def guid_to_id(guid):
+    # The same group GUIDs show up for most users, so memoize the conversion
+    return str(uuid.UUID(guid))
+
+
+@functools.lru_cache(maxsize=4096)
+def id_to_guid_filter(id):
+    return '(objectGUID={0})'.format(ldap3.utils.conv.escape_bytes(uuid.UUID(id).bytes_le))
+
+
 class RIDMapper(object):
     def __init__(self, context, params):
         self.context = context
@@ -200,18 +228,28 @@ class WinbindPlugin(DirectoryServicePlugin):
         self.uid_max = 100000000
         self.dc = None
         self.enabled = False
+        self.joined = False
+        self.recheck = False
         self.domain_info = None
         self.domain_name = None
         self.parameters = None
+        self.base_dn = None
+        self.principal = None
+        self.ticket_renewed_at = None
         self.directory = None
         self.ldap_servers = None
         self.ldap = None
         self.domain_sid = None
         self.domain_admins_sid = None
         self.domain_users_guid = None
+        self.domain_users_id = None
         self.wheel_group = None
         self.mapper = None
         self.workgroup = ''
+        self.wbc_context = None
+        self.wbc_lock = Lock()
+        self.negative_cache = OrderedDict()
+        self.negative_cache_lock = Lock()
         self.cv = Condition()
         self.bind_thread = Thread(target=self.bind, daemon=True)
         self.bind_thread.start()
@@ -231,17 +269,32 @@ class WinbindPlugin(DirectoryServicePlugin):
     def realm(self):
         return self.parameters['realm']
 
-    @property
-    def base_dn(self):
-        return domain_to_dn(self.realm)
-
     @property
     def wbc(self):
-        return wbclient.Context()
+        # Build the winbind client context once and reuse it until we leave the domain
+        with self.wbc_lock:
+            if not self.wbc_context:
+                self.wbc_context = wbclient.Context()
 
-    @property
-    def principal(self):
-        return '{0}@{1}'.format(self.parameters['username'], self.parameters['realm'].upper())
+            return self.wbc_context
+
+    def reset_wbc(self):
+        with self.wbc_lock:
+            self.wbc_context = None
+
+        # Lookups must not trust the joined flag until the bind thread checks the domain again
+        self.joined = False
+
+    def wbc_failed(self):
+        self.reset_wbc()
+
+        # Wake the bind thread for an early check, unless it is busy and will get there on its own
+        if self.cv.acquire(blocking=False):
+            try:
+                self.recheck = True
+                self.cv.notify_all()
+            finally:
+                self.cv.release()
 
     @property
     def domain_users_sid(self):
@@ -283,8 +336,8 @@ class WinbindPlugin(DirectoryServicePlugin):
 
             # Check if we can fetch domain SID
             try:
-                subprocess.check_output(['/usr/local/bin/net', 'getdomainsid'])
-            except subprocess.CalledProcessError:
+                subprocess.check_output(['/usr/local/bin/net', 'getdomainsid'], timeout=NET_TIMEOUT)
+            except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
                 logger.debug('Cannot fetch domain SID')
                 return False
 
@@ -295,8 +348,14 @@ class WinbindPlugin(DirectoryServicePlugin):
 
         return True
 
-    def __renew_ticket(self):
+    def renew_ticket(self):
+        # Talk to the KDC only when the ticket is gone or the last renewal is getting old
+        if self.ticket_renewed_at and have_ticket(self.principal):
+            if time.monotonic() - self.ticket_renewed_at < TICKET_RENEW_INTERVAL:
+                return
+
         obtain_or_renew_ticket(self.principal, self.parameters['password'])
+        self.ticket_renewed_at = time.monotonic()
 
     def search(self, search_base, search_filter, attributes=None):
         if self.ldap.closed:
@@ -330,6 +389,28 @@ class WinbindPlugin(DirectoryServicePlugin):
     def search_one(self, *args, **kwargs):
         return first_or_default(None, self.search(*args, **kwargs))
 
+    def lookup(self, key, fetch):
+        # Remember misses for a few seconds, so lookup storms for unknown names do not all reach the DC
+        with self.negative_cache_lock:
+            expires_at = self.negative_cache.get(key)
+            if expires_at:
+                if expires_at > time.monotonic():
+                    return
+
+                del self.negative_cache[key]
+
+        result = fetch()
+        if result is None:
+            expires_at = time.monotonic() + min(NEGATIVE_CACHE_TTL, self.context.cache_ttl)
+            with self.negative_cache_lock:
+                # Entries share one TTL, so insertion order is expiry order and the oldest go first
+                self.negative_cache.pop(key, None)
+                self.negative_cache[key] = expires_at
+                while len(self.negative_cache) > NEGATIVE_CACHE_SIZE:
+                    self.negative_cache.popitem(last=False)
+
+        return result
+
     def get_netbios_domain_name(self):
         partition = self.search_one(f'cn=Partitions,cn=Configuration,{self.base_dn}', '(nETBIOSName=*)')
         return partition['attributes']['nETBIOSName']
@@ -364,32 +445,49 @@ class WinbindPlugin(DirectoryServicePlugin):
 
     def bind(self):
         logger.debug('Bind thread: starting')
+        interval = WINBINDD_KEEPALIVE
         while True:
             with self.cv:
-                notify = self.cv.wait(60)
+                # Back off while the domain stays healthy, check again quickly after any failure.
+                # The cap stays well below the usual ticket lifetime, so renewals are never missed.
+                if self.directory and self.directory.state == DirectoryState.BOUND and self.joined:
+                    interval = min(interval * 2, WINBINDD_KEEPALIVE_MAX)
+                else:
+                    interval = WINBINDD_KEEPALIVE
+
+                notify = self.cv.wait(interval)
+                recheck, self.recheck = self.recheck, False
 
-                if notify:
+                if notify and not recheck:
                     if self.is_joined() and self.enabled:
                         self.directory.put_state(DirectoryState.EXITING)
                         self.leave()
 
                 if self.enabled:
                     try:
-                        obtain_or_renew_ticket(self.principal, self.parameters['password'])
+                        self.renew_ticket()
                     except krb5.KrbException as err:
                         self.directory.put_status(errno.ENXIO, '{0} <{1}>'.format(str(err), type(err).__name__))
                         self.directory.put_state(DirectoryState.FAILURE)
                         continue
 
-                    if not self.is_joined(True):
+                    # Lookups rely on this flag instead of querying winbind on every call
+                    self.joined = self.is_joined(True)
+                    if not self.joined:
                         # Try to rejoin
                         logger.debug('Keepalive thread: rejoining')
                         self.directory.put_state(DirectoryState.JOINING)
                         if not self.join():
                             continue
                     else:
-                        self.domain_info = self.wbc.get_domain_info(self.realm)
-                        self.domain_name = self.wbc.interface.netbios_domain
+                        try:
+                            self.domain_info = self.wbc.get_domain_info(self.realm)
+                            self.domain_name = self.wbc.interface.netbios_domain
+                        except wbclient.WinbindException as err:
+                            self.reset_wbc()
+                            self.directory.put_status(errno.ENXIO, '{0} <{1}>'.format(str(err), type(err).__name__))
+                            self.directory.put_state(DirectoryState.FAILURE)
+                            continue
 
                     if self.directory.state != DirectoryState.BOUND:
                         try:
@@ -409,6 +507,7 @@ class WinbindPlugin(DirectoryServicePlugin):
                                 raise RuntimeError('Failed to fetch Domain Users')
 
                             self.domain_users_guid = uuid.UUID(du['attributes']['objectGUID'])
+                            self.domain_users_id = str(self.domain_users_guid)
                             logger.debug('Domain Users GUID is {0}'.format(self.domain_users_guid))
                         except BaseException as err:
                             logger.debug('Failure details', exc_info=True)
@@ -447,23 +546,52 @@ class WinbindPlugin(DirectoryServicePlugin):
             'template homedir': '/home/%U'
         }
 
-        if enable:
-            for k, v in params.items():
-                logger.debug('Setting samba parameter "{0}" to "{1}"'.format(k, v))
-                cfg[k] = v
+        def set_param(k, v):
+            # Registry writes are tdb transactions, so skip values that are already in place
+            with contextlib.suppress(KeyError):
+                if cfg[k] == v:
+                    return
+
+            logger.debug('Setting samba parameter "{0}" to "{1}"'.format(k, v))
+            cfg[k] = v
+            changed.add(k)
+
+        changed = set()
+        cfg.transaction_start()
+        try:
+            if enable:
+                for k, v in params.items():
+                    set_param(k, v)
+            else:
+                for k in params:
+                    del cfg[k]
+                    changed.add(k)
+
+                params = {
+                    'server role': 'auto',
+                    'workgroup': self.context.configstore.get('service.smb.workgroup'),
+                    'local master': yesno(self.context.configstore.get('service.smb.local_master'))
+                }
+
+                for k, v in params.items():
+                    set_param(k, v)
+        except BaseException:
+            cfg.transaction_cancel()
+            raise
         else:
-            for k in params:
-                del cfg[k]
+            cfg.transaction_commit()
 
-            params = {
-                'server role': 'auto',
-                'workgroup': self.context.configstore.get('service.smb.workgroup'),
-                'local master': yesno(self.context.configstore.get('service.smb.local_master'))
-            }
+        if not changed:
+            logger.debug('Samba configuration unchanged, not restarting')
+            return
 
-            for k, v in params.items():
-                logger.debug('Setting samba parameter "{0}" to "{1}"'.format(k, v))
-                cfg[k] = v
+        # Daemons pick up most parameters on reload, only a role or domain change needs a restart
+        if not changed & SMB_RESTART_PARAMETERS:
+            try:
+                smbconf.SambaMessagingContext().reload_config()
+                return
+            except OSError:
+                logger.debug('Cannot reload samba configuration, restarting instead', exc_info=True)
 
         self.context.client.call_sync('service.restart', 'smb')
 
@@ -482,23 +610,20 @@ class WinbindPlugin(DirectoryServicePlugin):
 
         dn = entry['dn']
         entry = dict(entry['attributes'])
-        if 'user' not in get(entry, 'objectClass'):
+        object_class = entry.get('objectClass') or []
+        if 'user' not in object_class or 'computer' in object_class:
             # not a user
             return
 
-        if 'computer' in get(entry, 'objectClass'):
-            # not a user
-            return
-
-        username = get(entry, 'sAMAccountName')
-        usersid = get(entry, 'objectSid')
+        username = entry.get('sAMAccountName')
+        usersid = entry.get('objectSid')
         groups = []
         uid = self.mapper.get_uid(entry)
 
         if uid is None:
             return
 
-        if get(entry, 'memberOf'):
+        if entry.get('memberOf'):
             builder = LdapQueryBuilder()
             qstr = builder.build_query([
                 ('member', '=', dn),
@@ -507,26 +632,25 @@ class WinbindPlugin(DirectoryServicePlugin):
 
             for r in self.search(self.base_dn, qstr, attributes=['objectGUID', 'objectSid']):
                 r = dict(r['attributes'])
-                guid = uuid.UUID(get(r, 'objectGUID'))
-                groups.append(str(guid))
+                groups.append(guid_to_id(get(r, 'objectGUID')))
 
                 # Append wheel group to users being in Domain Admins group
                 if r['objectSid'] == self.domain_admins_sid and self.wheel_group:
                     groups.append(self.wheel_group['id'])
 
         return {
-            'id': str(uuid.UUID(get(entry, 'objectGUID'))),
+            'id': guid_to_id(entry.get('objectGUID')),
             'sid': str(usersid),
             'uid': uid,
             'builtin': False,
             'username': username,
             'aliases': [f'{self.workgroup}\\{username}'],
-            'full_name': get(entry, 'name'),
+            'full_name': entry.get('name'),
             'email': None,
             'locked': False,
             'sudo': False,
             'password_disabled': False,
-            'group': str(self.domain_users_guid),
+            'group': self.domain_users_id,
             'groups': groups,
             'shell': '/bin/sh',
             'home': self.context.get_home_directory(self.directory, username)
@@ -537,31 +661,31 @@ class WinbindPlugin(DirectoryServicePlugin):
             return
 
         entry = dict(entry['attributes'])
-        if 'group' not in get(entry, 'objectClass'):
+        if 'group' not in (entry.get('objectClass') or []):
             # not a group
             return
 
-        groupname = get(entry, 'sAMAccountName')
-        groupsid = get(entry, 'objectSid')
+        groupname = entry.get('sAMAccountName')
+        groupsid = entry.get('objectSid')
+        member_of = entry.get('memberOf')
         parents = []
         gid = self.mapper.get_gid(entry)
 
         if gid is None:
             return
 
-        if get(entry, 'memberOf'):
+        if member_of:
             builder = LdapQueryBuilder()
             qstr = builder.build_query([
-                ('distinguishedName', 'in', get(entry, 'memberOf'))
+                ('distinguishedName', 'in', member_of)
             ])
 
             for r in self.search(self.base_dn, qstr):
                 r = dict(r['attributes'])
-                guid = uuid.UUID(get(r, 'objectGUID'))
-                parents.append(str(guid))
+                parents.append(guid_to_id(get(r, 'objectGUID')))
 
         return {
-            'id': str(uuid.UUID(get(entry, 'objectGUID'))),
+            'id': guid_to_id(entry.get('objectGUID')),
             'sid': str(groupsid),
             'gid': gid,
             'builtin': False,
@@ -573,7 +697,7 @@ class WinbindPlugin(DirectoryServicePlugin):
 
     def getpwent(self, filter=None, params=None):
         logger.debug('getpwent(filter={0}, params={1})'.format(filter, params))
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getpwent: not joined')
             return []
 
@@ -588,19 +712,18 @@ class WinbindPlugin(DirectoryServicePlugin):
         return (self.convert_user(i) for i in results)
 
     def getpwuid(self, uid):
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getpwuid: not joined')
             return
 
-        return self.mapper.get_by_uid(uid)
+        return self.lookup(('uid', uid), lambda: self.mapper.get_by_uid(uid))
 
     def getpwuuid(self, id):
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getpwuuid: not joined')
             return
 
-        guid = ldap3.utils.conv.escape_bytes(uuid.UUID(id).bytes_le)
-        return self.convert_user(self.search_one(self.base_dn, '(objectGUID={0})'.format(guid)))
+        return self.convert_user(self.search_one(self.base_dn, id_to_guid_filter(id)))
 
     def getpwnam(self, name):
         if '\\' in name:
@@ -608,15 +731,17 @@ class WinbindPlugin(DirectoryServicePlugin):
             if domain != self.domain_name:
                 return
 
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getpwnam: not joined')
             return
 
-        return self.convert_user(self.search_one(self.base_dn, '(sAMAccountName={0})'.format(name)))
+        return self.lookup(('user', name), lambda: self.convert_user(
+            self.search_one(self.base_dn, '(sAMAccountName={0})'.format(name))
+        ))
 
     def getgrent(self, filter=None, params=None):
         logger.debug('getgrent(filter={0}, params={1})'.format(filter, params))
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getgrent: not joined')
             return []
 
@@ -636,29 +761,30 @@ class WinbindPlugin(DirectoryServicePlugin):
             if domain != self.domain_name:
                 return
 
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getgrnam: not joined')
             return
 
-        return self.convert_group(self.search_one(self.base_dn, f'(sAMAccountName={name})'))
+        return self.lookup(('group', name), lambda: self.convert_group(
+            self.search_one(self.base_dn, f'(sAMAccountName={name})')
+        ))
 
     def getgruuid(self, id):
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getgruuid: not joined')
             return
 
-        guid = ldap3.utils.conv.escape_bytes(uuid.UUID(id).bytes_le)
-        return self.convert_group(self.search_one(self.base_dn, f'(objectGUID={guid})'))
+        return self.convert_group(self.search_one(self.base_dn, id_to_guid_filter(id)))
 
     def getgrgid(self, gid):
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getgrgid: not joined')
             return
 
-        return self.mapper.get_by_gid(gid)
+        return self.lookup(('gid', gid), lambda: self.mapper.get_by_gid(gid))
 
     def getsid(self, sid):
-        if not self.is_joined():
+        if not self.joined:
             logger.debug('getsid: not joined')
             return
 
@@ -678,7 +804,14 @@ class WinbindPlugin(DirectoryServicePlugin):
             if domain != self.domain_name:
                 return False
 
-        return self.wbc.authenticate(f'{self.domain_name}\\{username}', password)
+        try:
+            return self.wbc.authenticate(f'{self.domain_name}\\{username}', password)
+        except wbclient.WinbindException as err:
+            # Only a lost winbindd says anything about the domain, a rejected password does not
+            if err.code == wbclient.WinbindErrorCode.WINBIND_NOT_AVAILABLE:
+                self.wbc_failed()
+
+            raise
 
     def configure(self, enable, directory):
         with self.cv:
@@ -686,6 +819,13 @@ class WinbindPlugin(DirectoryServicePlugin):
             self.enabled = enable
             self.directory = directory
             self.parameters = directory.parameters
+            # Derived once here instead of on every search and ticket check
+            self.base_dn = domain_to_dn(self.realm)
+            self.principal = '{0}@{1}'.format(self.parameters['username'], self.realm.upper())
+            self.ticket_renewed_at = None
+            self.recheck = False
+            # Do not wait for the next keepalive round to learn whether lookups can be served
+            self.joined = enable and self.ldap is not None and self.is_joined()
             if directory.min_uid:
                 self.uid_min = directory.min_uid
                 self.uid_max = directory.max_uid
@@ -713,13 +853,21 @@ class WinbindPlugin(DirectoryServicePlugin):
             self.configure_smb(True)
 
             try:
-                subprocess.check_output(['/usr/local/bin/net', 'ads', 'join', self.realm, '-k'])
+                subprocess.check_output(
+                    ['/usr/local/bin/net', 'ads', 'join', self.realm, '-k'],
+                    stderr=subprocess.STDOUT,
+                    timeout=NET_ADS_JOIN_TIMEOUT
+                )
             except subprocess.CalledProcessError as err:
                 # Undo possibly partially successful join
-                subprocess.call(['/usr/local/bin/net', 'ads', 'leave', '-k'])
+                call_net('ads', 'leave', '-k')
                 raise RuntimeError(err.output.decode('utf-8'))
+            except subprocess.TimeoutExpired:
+                call_net('ads', 'leave', '-k')
+                raise RuntimeError(f'Joining {self.realm} timed out after {NET_ADS_JOIN_TIMEOUT} seconds')
 
             self.context.client.call_sync('serviced.job.restart', 'org.samba.winbindd')
+            self.reset_wbc()
             logger.debug('Done restarting winbind')
 
             # Retry few times in case samba haven't finished restarting yet
@@ -745,18 +893,27 @@ class WinbindPlugin(DirectoryServicePlugin):
             self.directory.put_state(DirectoryState.FAILURE)
             return False
 
+        with self.negative_cache_lock:
+            self.negative_cache.clear()
+
+        self.joined = True
         logger.info(f'Sucessfully joined to the domain {self.realm}')
         return True
 
     def leave(self):
         logger.info('Leaving domain')
-        subprocess.call(['/usr/local/bin/net', 'cache', 'flush'])
-        subprocess.call(['/usr/local/bin/net', 'ads', 'leave', '-k'])
+        self.joined = False
+        call_net('cache', 'flush')
+        call_net('ads', 'leave', '-k')
         self.configure_smb(False)
         self.dc = None
         self.domain_name = None
         self.domain_info = None
         self.ldap = None
+        with self.negative_cache_lock:
+            self.negative_cache.clear()
+
+        self.reset_wbc()
 
     def get_kerberos_realm(self, parameters):
         ret = {
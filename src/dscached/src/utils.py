@@ -183,7 +183,11 @@ def parse_uuid2(value):
 
 
 def split_sid(sid):
-    return sid.rsplit('-', 1)
+    base, sep, rid = sid.rpartition('-')
+    if not sep:
+        raise ValueError('Invalid SID')
+
+    return base, rid
 
 
 def rid_to_xid(rid, base):
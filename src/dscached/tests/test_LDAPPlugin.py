@@ -0,0 +1,205 @@
+#
+# Copyright 2016 iXsystems, Inc.
+# All rights reserved
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted providing that the following conditions
+# are met:
+# 1. Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+# 2. Redistributions in binary form must reproduce the above copyright
+#    notice, this list of conditions and the following disclaimer in the
+#    documentation and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE AUTHOR ``AS IS'' AND ANY EXPRESS OR
+# IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED.  IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS
+# OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION)
+# HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT,
+# STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING
+# IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#
+#####################################################################
+
+
+import copy
+import threading
+import unittest
+from unittest import mock
+
+import LDAPPlugin as ldap_plugin
+from plugin import DirectoryState
+
+
+class FakeDirectory(object):
+    def __init__(self, parameters):
+        self.name = 'ldap'
+        self.parameters = parameters
+        self.state = DirectoryState.DISABLED
+        self.status = None
+        self.changed = threading.Condition()
+
+    def put_state(self, state):
+        with self.changed:
+            self.state = state
+            self.changed.notify_all()
+
+    def put_status(self, code, message):
+        self.status = (code, message)
+
+    def wait_for_state(self, state, timeout=5):
+        with self.changed:
+            return self.changed.wait_for(lambda: self.state == state, timeout)
+
+
+class LDAPPluginTestCase(unittest.TestCase):
+    def setUp(self):
+        for name, value in (('Connection', mock.DEFAULT), ('Server', mock.DEFAULT)):
+            patcher = mock.patch.object(ldap_plugin.ldap3, name, value)
+            setattr(self, name.lower(), patcher.start())
+            self.addCleanup(patcher.stop)
+
+        patcher = mock.patch.object(ldap_plugin, 'BIND_CHECK_INTERVAL', 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        parameters = copy.deepcopy(ldap_plugin.DEFAULT_PARAMETERS)
+        parameters.update({
+            'server': 'ldap.example.com',
+            'base_dn': 'dc=example,dc=com',
+            'bind_dn': 'cn=admin,dc=example,dc=com',
+            'password': 'secret'
+        })
+
+        self.context = mock.Mock()
+        self.directory = FakeDirectory(parameters)
+        self.plugin = ldap_plugin.LDAPPlugin(self.context)
+        self.addCleanup(self.plugin.configure, False, self.directory)
+
+
+class TestBind(LDAPPluginTestCase):
+    def test_retry_after_failure(self):
+        self.connection.return_value.bind.side_effect = [False, True]
+        self.plugin.configure(True, self.directory)
+
+        # The second attempt must come from the periodic wakeup, not from another configure() call
+        self.assertTrue(self.directory.wait_for_state(DirectoryState.BOUND))
+        self.assertEqual(self.connection.return_value.bind.call_count, 2)
+        self.assertIs(self.plugin.conn, self.connection.return_value)
+
+
+class TestEnumerationCache(LDAPPluginTestCase):
+    def test_small_enumeration_cached(self):
+        fetch = mock.Mock(side_effect=lambda: iter([{'name': 'a'}, {'name': 'b'}]))
+        first = list(self.plugin.cached_enumeration('users', fetch))
+        first[0]['name'] = 'changed'
+
+        self.assertEqual(list(self.plugin.cached_enumeration('users', fetch)), [{'name': 'a'}, {'name': 'b'}])
+        self.assertEqual(fetch.call_count, 1)
+
+    def test_large_enumeration_streamed(self):
+        size = ldap_plugin.ENUMERATION_CACHE_SIZE + 10
+        fetch = mock.Mock(side_effect=lambda: ({'uid': i} for i in range(size)))
+
+        self.assertEqual(len(list(self.plugin.cached_enumeration('users', fetch))), size)
+        self.assertEqual(len(list(self.plugin.cached_enumeration('users', fetch))), size)
+        self.assertEqual(fetch.call_count, 2)
+        self.assertNotIn('users', self.plugin.enumeration_cache)
+
+
+class CountingEvent(threading.Event):
+    def __init__(self):
+        super(CountingEvent, self).__init__()
+        self.waiters = 0
+        self.cv = threading.Condition()
+
+    def wait(self, timeout=None):
+        with self.cv:
+            self.waiters += 1
+            self.cv.notify_all()
+
+        return super(CountingEvent, self).wait(timeout)
+
+    def wait_for_waiters(self, count, timeout=5):
+        with self.cv:
+            return self.cv.wait_for(lambda: self.waiters >= count, timeout)
+
+
+class TestSingleFlight(LDAPPluginTestCase):
+    WAITERS = 4
+
+    def run_concurrently(self, fetch):
+        # Start the owner, let the waiters block on its lookup, then let fetch() finish
+        started = threading.Event()
+        release = threading.Event()
+        results = {}
+
+        def blocking_fetch():
+            started.set()
+            release.wait(5)
+            return fetch()
+
+        def call(name, fn):
+            try:
+                results[name] = ('result', self.plugin.single_flight('key', fn))
+            except Exception as err:
+                results[name] = ('error', err)
+
+        owner = threading.Thread(target=call, args=('owner', blocking_fetch))
+        owner.start()
+        self.assertTrue(started.wait(5))
+
+        done = CountingEvent()
+        self.plugin.pending_lookups['key'].done = done
+        waiters = [
+            threading.Thread(target=call, args=(i, mock.Mock(side_effect=AssertionError)))
+            for i in range(self.WAITERS)
+        ]
+
+        for i in waiters:
+            i.start()
+
+        self.assertTrue(done.wait_for_waiters(self.WAITERS))
+        release.set()
+        for i in [owner] + waiters:
+            i.join(5)
+
+        return results
+
+    def test_concurrent_callers_share_fetch(self):
+        fetch = mock.Mock(return_value={'username': 'alice'})
+        results = self.run_concurrently(fetch)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(len(results), self.WAITERS + 1)
+        kind, owner_result = results.pop('owner')
+        self.assertEqual(kind, 'result')
+        for kind, result in results.values():
+            self.assertEqual(kind, 'result')
+            self.assertEqual(result, owner_result)
+            self.assertIsNot(result, owner_result)
+
+        self.assertEqual(self.plugin.pending_lookups, {})
+
+    def test_exception_in_owner(self):
+        error = RuntimeError('server down')
+        fetch = mock.Mock(side_effect=error)
+        results = self.run_concurrently(fetch)
+
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(len(results), self.WAITERS + 1)
+        for kind, result in results.values():
+            self.assertEqual(kind, 'error')
+            self.assertIs(result, error)
+
+        # The failed lookup must not stick around, the next caller fetches again
+        self.assertEqual(self.plugin.pending_lookups, {})
+        self.assertEqual(self.plugin.single_flight('key', lambda: 'ok'), 'ok')
+
+
+if __name__ == '__main__':
+    unittest.main()
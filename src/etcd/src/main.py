@@ -34,8 +34,9 @@ import json
 import errno
 import datastore
 import time
-import imp
+import importlib.util
 import renderers
+from threading import Lock
 from bsd import setproctitle
 from datastore.config import ConfigStore
 from freenas.dispatcher.client import Client, ClientError
@@ -71,8 +72,7 @@ class FileGenerationService(RpcService):
         self.datastore = ctx.datastore
 
     def generate_all(self):
-        for group in self.datastore.query('etcd.groups'):
-            self.generate_group(group['name'])
+        self.generate_groups([g['name'] for g in self.datastore.query('etcd.groups')])
 
     def generate_file(self, filename):
         if filename not in self.context.managed_files.keys():
@@ -96,14 +96,13 @@ class FileGenerationService(RpcService):
             return
 
         try:
-            pname = os.path.basename(name)
-            plugin = imp.load_source(pname, self.context.managed_files[name])
+            plugin = self.context.load_plugin(name)
         except:
             self.context.logger.error('Invalid plugin source file: {0}'.format(name), exc_info=True)
             return
 
         if not hasattr(plugin, 'run'):
-            self.context.logger.error('Invalid plugin source {0}, no run method'.format(pname))
+            self.context.logger.error('Invalid plugin source {0}, no run method'.format(os.path.basename(name)))
             return
 
         try:
@@ -112,19 +111,35 @@ class FileGenerationService(RpcService):
             self.context.logger.error('Cannot run plugin {0}: {1}'.format(name, str(err)), exc_info=True)
 
     def generate_group(self, name):
-        group = self.datastore.get_one('etcd.groups', ('name', '=', name))
-        if not group:
-            raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+        self.generate_groups([name])
 
-        for i in group['dependencies']:
-            typ, fname = i.split(':')
+    def generate_groups(self, names):
+        # Regenerate several groups in one call, visiting dependencies shared between them only once
+        done = set()
 
-            if typ == 'file':
-                self.generate_file(fname)
-            elif typ == 'plugin':
-                self.generate_plugin(fname)
-            elif typ == 'group':
-                self.generate_group(fname)
+        def generate(name):
+            group = self.datastore.get_one('etcd.groups', ('name', '=', name))
+            if not group:
+                raise RpcException(errno.ENOENT, 'Group {0} not found'.format(name))
+
+            for i in group['dependencies']:
+                if i in done:
+                    continue
+
+                done.add(i)
+                typ, fname = i.split(':')
+
+                if typ == 'file':
+                    self.generate_file(fname)
+                elif typ == 'plugin':
+                    self.generate_plugin(fname)
+                elif typ == 'group':
+                    generate(fname)
+
+        for name in names:
+            if 'group:{0}'.format(name) not in done:
+                done.add('group:{0}'.format(name))
+                generate(name)
 
     def get_managed_files(self):
         return self.context.managed_files
@@ -146,6 +161,8 @@ class Main(object):
         self.plugin_dirs = []
         self.renderers = {}
         self.managed_files = {}
+        self.plugin_cache = {}
+        self.plugin_lock = Lock()
 
     def init_datastore(self):
         try:
@@ -220,6 +237,30 @@ class Main(object):
                     self.managed_files[name] = abspath
                     self.logger.info('Adding managed file %s [%s]', name, ext)
 
+    def load_plugin(self, name):
+        # Reuse the compiled plugin module as long as its source file did not change
+        path = self.managed_files[name]
+        with self.plugin_lock:
+            st = os.stat(path)
+            key = (st.st_mtime_ns, st.st_size)
+            cached = self.plugin_cache.get(path)
+            if cached and cached[0] == key:
+                return cached[1]
+
+            # Unlike imp.load_source(), this goes through the regular __pycache__ bytecode cache
+            spec = importlib.util.spec_from_file_location(os.path.basename(name), path)
+            plugin = importlib.util.module_from_spec(spec)
+            sys.modules[spec.name] = plugin
+            try:
+                spec.loader.exec_module(plugin)
+            except BaseException:
+                # Do not leave a half-initialized module behind
+                sys.modules.pop(spec.name, None)
+                raise
+
+            self.plugin_cache[path] = (key, plugin)
+            return plugin
+
     def generate_file(self, file_path):
         if file_path not in self.managed_files.keys():
             raise RpcException(errno.ENOENT, 'No such file')